@@ -0,0 +1,34 @@
+from remote_index import DEFAULT_MAX_AGE # for how long --reconcile trusts its cached list of what's in iKnow
+
+# How often (in seconds) --watch checks vocab.db for new lookups, unless the config says otherwise
+WATCH_INTERVAL = 5.0
+
+
+# How one account talks to iKnow: its login, and how hard and how fast it's allowed to go.
+# Made once per account (see from_info) and handed to everything that sets up requests,
+# so they don't each need the settings one by one.
+class AccountSettings:
+    def __init__(self, cookies: str, csrf_token: str, workers: int = 4, requests_per_second: float = 4.0, timeout: float = 30.0,
+                 base_url: str = 'https://iknow.jp', preprocess_workers: int = None, remote_index_max_age: float = DEFAULT_MAX_AGE,
+                 watch_interval: float = WATCH_INTERVAL):
+        self.cookies = cookies
+        self.csrf_token = csrf_token
+        # How many uploads to run at once, and how hard we're allowed to hit iKnow
+        self.workers = workers
+        self.requests_per_second = requests_per_second
+        self.timeout = timeout
+        # Where to send requests - only worth changing to point at a fake server (see fake_iknow.py)
+        self.base_url = base_url
+        # How many processes to transliterate with. None is one per core, 0 does it all in this process
+        self.preprocess_workers = preprocess_workers
+        # How long (in seconds) --reconcile trusts its cached list of what's in iKnow for
+        self.remote_index_max_age = remote_index_max_age
+        # How often (in seconds) --watch checks vocab.db for new lookups
+        self.watch_interval = watch_interval
+
+    # Reads the settings out of a generation_info.json style dict, with defaults for the optional ones
+    @classmethod
+    def from_info(cls, info: dict) -> 'AccountSettings':
+        return cls(info['cookies'], info['csrf_token'], info.get('workers', 4), info.get('requests_per_second', 4.0),
+                   info.get('timeout', 30.0), info.get('base_url', 'https://iknow.jp'), info.get('preprocess_workers', None),
+                   info.get('remote_index_max_age', DEFAULT_MAX_AGE), info.get('watch_interval', WATCH_INTERVAL))
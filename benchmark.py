@@ -0,0 +1,184 @@
+import argparse # for picking what to benchmark
+import contextlib # for silencing the importer's output
+import io # for silencing the importer's output
+import json # for the synthetic kindle data and passing results back
+import os # for paths
+import statistics # for the median startup time
+import subprocess # for running each import in a fresh process
+import sys # for finding python
+import tempfile # for a clean working directory per run
+import time # for timing
+from fake_iknow import FakeIKnowServer
+
+try:
+    import resource # for peak memory - not available on windows
+except ImportError:
+    resource = None
+
+DEFAULT_SIZES = [1000, 10000, 50000]
+IMPORTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'import_to_iknow.py')
+# Words per synthetic book, so bigger datasets also mean more books and courses
+WORDS_PER_BOOK = 500
+
+# Pieces of sentences to build sample sentences out of. The numbers in each word's sentence keep most
+# of them distinct, so the transliteration cache doesn't make the big runs look better than they are
+SUBJECTS = ['学生', '先生', '猫', '友達', '子供たち', '旅行者']
+PLACES = ['東京', '図書館', '公園', '駅前の喫茶店', '京都の古い寺', '海辺']
+ACTIONS = ['本を読んでいます', '日本語を勉強しました', '写真を撮りたい', '静かに待っていた', '昼ご飯を食べる', '手紙を書いている']
+
+
+# Writes a kindle data JSON file with the given number of distinct words to path
+def write_kindle_data(path: str, size: int) -> None:
+    books = []
+    for start in range(0, size, WORDS_PER_BOOK):
+        words = []
+        for i in range(start, min(size, start + WORDS_PER_BOOK)):
+            sentence = '{n}人の{subject}が{place}で{action}。'.format(
+                n=i, subject=SUBJECTS[i % len(SUBJECTS)], place=PLACES[i // len(SUBJECTS) % len(PLACES)],
+                action=ACTIONS[i // (len(SUBJECTS) * len(PLACES)) % len(ACTIONS)])
+            words.append({
+                'word': '単語' + str(i),
+                'reading': 'たんご' + str(i),
+                'definition': 'word number ' + str(i),
+                'part_of_speech': 'noun',
+                # Some words don't come with a sample sentence
+                'sample': sentence if i % 10 else '',
+            })
+        books.append({'title': 'Benchmark Book ' + str(start // WORDS_PER_BOOK), 'words': words})
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'books': books}, f, ensure_ascii=False)
+
+# Peak resident memory in MB of this process and of the biggest child it waited on
+def peak_memory() -> tuple:
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+# Runs in a fresh process, in the working directory for this run so prior_results.json and the
+# transliteration cache start out empty. Prints the results as JSON on the last line
+def run_import(data_path: str, base_url: str, workers: int, requests_per_second: float, preprocess_workers: int) -> None:
+    # Imported here so the import time isn't counted, and so the cache gets made in the working directory
+    from import_to_iknow import convert_json_to_items
+    from account_settings import AccountSettings
+    output = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        settings = AccountSettings('benchmark=1', 'benchmark', workers, requests_per_second, base_url=base_url,
+                                   preprocess_workers=preprocess_workers)
+        finished = convert_json_to_items(settings, data_path)
+    seconds = time.perf_counter() - start
+    peak_mb, worker_peak_mb = peak_memory()
+    # The importer's own stage timings and latency percentiles
+    with open('import_metrics.json', 'r', encoding='utf-8') as m:
+        import_metrics = json.load(m)
+    print(json.dumps({'seconds': seconds, 'finished': finished, 'peak_mb': peak_mb, 'worker_peak_mb': worker_peak_mb,
+                      'stages': import_metrics['stages'], 'endpoints': import_metrics['endpoints']}))
+
+# Imports a synthetic dataset of size words into a fresh fake server, returning the results
+def benchmark(size: int, args) -> dict:
+    with tempfile.TemporaryDirectory(prefix='iknow-benchmark-') as work_dir:
+        data_path = os.path.join(work_dir, 'kindle_data.json')
+        write_kindle_data(data_path, size)
+        with FakeIKnowServer(latency=args.latency, error_rate=args.error_rate) as server:
+            command = [sys.executable, os.path.abspath(__file__), '--run', data_path, '--base-url', server.url,
+                       '--workers', str(args.workers), '--requests-per-second', str(args.requests_per_second)]
+            if args.preprocess_workers is not None:
+                command += ['--preprocess-workers', str(args.preprocess_workers)]
+            run = subprocess.run(command, cwd=work_dir, capture_output=True, text=True, encoding='utf-8')
+            if run.returncode != 0:
+                print(run.stdout)
+                print(run.stderr)
+                raise RuntimeError('Benchmark import of {size} words failed'.format(size=size))
+            result = json.loads(run.stdout.strip().splitlines()[-1])
+            server_stats = server.stats()
+    result['size'] = size
+    result['words_per_second'] = server_stats['items'] / result['seconds'] if result['seconds'] > 0 else 0
+    result['requests'] = server_stats
+    return result
+
+# Times how long the importer takes from a cold start to exit, for the runs that should be quick:
+# a bad config, nothing new to upload, nothing to retry, and a dry run. Returns {name: [seconds]}
+def benchmark_startup(repeat: int) -> dict:
+    with tempfile.TemporaryDirectory(prefix='iknow-startup-') as work_dir, FakeIKnowServer() as server:
+        write_kindle_data(os.path.join(work_dir, 'kindle_data.json'), 200)
+        info = {'cookies': 'benchmark=1', 'csrf_token': 'benchmark', 'kindle_data': 'kindle_data.json', 'vocab_db': '',
+                'base_url': server.url, 'requests_per_second': 0}
+        write_config(work_dir, dict(info, kindle_data=''))
+        runs = {'bad config': timed_runs(work_dir, [], repeat)}
+        # Everything gets uploaded once up front, so the rest find nothing new to do
+        write_config(work_dir, info)
+        subprocess.run([sys.executable, IMPORTER], cwd=work_dir, capture_output=True, check=True)
+        runs['nothing new'] = timed_runs(work_dir, [], repeat)
+        runs['nothing to retry'] = timed_runs(work_dir, ['--retry-failures'], repeat)
+        runs['dry run'] = timed_runs(work_dir, ['--dry-run'], repeat)
+    return runs
+
+def write_config(work_dir: str, info: dict) -> None:
+    with open(os.path.join(work_dir, 'generation_info.json'), 'w', encoding='utf-8') as g:
+        json.dump(info, g)
+
+def timed_runs(work_dir: str, extra_args: list, repeat: int) -> list:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, IMPORTER] + extra_args, cwd=work_dir, capture_output=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+def print_startup(runs: dict) -> None:
+    print('{:>18} {:>10} {:>10}'.format('run', 'min ms', 'median ms'))
+    for name, times in runs.items():
+        print('{:>18} {:>10.0f} {:>10.0f}'.format(name, min(times) * 1000, statistics.median(times) * 1000))
+
+def print_results(results: list) -> None:
+    print('{:>8} {:>9} {:>10} {:>8} {:>7} {:>10} {:>7} {:>10} {:>12}'.format(
+        'words', 'seconds', 'words/sec', 'courses', 'items', 'sentences', 'errors', 'peak MB', 'worker MB'))
+    for result in results:
+        requests = result['requests']
+        print('{:>8} {:>9.2f} {:>10.1f} {:>8} {:>7} {:>10} {:>7} {:>10} {:>12}'.format(
+            result['size'], result['seconds'], result['words_per_second'], requests['courses'], requests['items'],
+            requests['sentences'], requests['errors'], format_mb(result['peak_mb']), format_mb(result['worker_peak_mb'])))
+
+def format_mb(mb: float) -> str:
+    return 'n/a' if mb is None else '{:.1f}'.format(mb)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark importing synthetic kindle data into a local fake iKnow server')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='how many words to import in each run')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--requests-per-second', type=float, default=0, help='0 (the default) means no limit')
+    parser.add_argument('--preprocess-workers', type=int, default=None)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every fake iKnow request takes')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of fake iKnow requests that fail with a 503')
+    parser.add_argument('--json', help='also write the results to this file, for comparing runs')
+    parser.add_argument('--startup', action='store_true', help='time how long quick runs (nothing to do, bad config...) take to start and exit instead')
+    parser.add_argument('--repeat', type=int, default=5, help='how many times to time each startup run')
+    # Used internally to run a single import in its own process
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--base-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_import(args.run, args.base_url, args.workers, args.requests_per_second, args.preprocess_workers)
+        sys.exit(0)
+
+    if args.startup:
+        runs = benchmark_startup(args.repeat)
+        print_startup(runs)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(runs, f, indent=4)
+        sys.exit(0)
+
+    results = []
+    for size in args.sizes:
+        print('Importing {size} words...'.format(size=size))
+        results.append(benchmark(size, args))
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
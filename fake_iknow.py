@@ -0,0 +1,163 @@
+import argparse # for running the server on its own
+import itertools # for handing out ids
+import json # for item/sentence responses
+import random # for injecting errors
+import re # for routing
+import threading # for running the server in the background and guarding its state
+import time # for simulating latency
+import urllib.parse # for reading the posted forms
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import brotlicffi # iKnow brotli compresses everything it sends back
+
+COURSE_PATH = re.compile(r'^/custom/courses/?$')
+ITEM_PATH = re.compile(r'^/custom/courses/(\d+)/items/?$')
+SENTENCE_PATH = re.compile(r'^/custom/courses/(\d+)/items/(\d+)/sentences/?$')
+# How many courses/items come back in each page of a listing
+LIST_PAGE_SIZE = 50
+
+
+# A stand-in for the bits of iknow.jp the importer talks to, for testing and benchmarking without
+# touching the real site. Responses are brotli compressed and shaped like the real ones:
+#   POST /custom/courses                               -> jquery that redirects to /custom/courses/{id}
+#   POST /custom/courses/{id}/items                    -> {"id": item id}
+#   POST /custom/courses/{id}/items/{item id}/sentences -> {"id": sentence id}
+#   GET /custom/courses?page=n                         -> {"courses": [{"id", "title"}], "next_page"}
+#   GET /custom/courses/{id}/items?page=n              -> {"items": [{"id", "word", "sentences"}], "next_page"}
+# Listings come LIST_PAGE_SIZE at a time, with a null next_page on the last page.
+# Every request waits latency seconds, and fails with a 503 error_rate of the time.
+class FakeIKnowServer:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        # course id -> {"title", "items": {item id: {"word", "sentences"}}}
+        self.courses = {}
+        self.requests = {'courses': 0, 'items': 0, 'sentences': 0, 'listings': 0, 'errors': 0}
+        self.httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, like the real thing, and no waiting on delayed ACKs for small responses
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                form = urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8'))
+                self.respond(*server.handle(self.path, form))
+
+            def do_GET(self):
+                self.respond(*server.handle_get(self.path))
+
+            def respond(self, status: int, body: bytes):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return 'http://{host}:{port}'.format(host=host, port=port)
+
+    # Works out the response to a post. Returns (status code, body)
+    def handle(self, path: str, form: dict) -> tuple:
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self.lock:
+            if self.error_rate > 0 and random.random() < self.error_rate:
+                self.requests['errors'] += 1
+                return 503, b''
+            match = COURSE_PATH.match(path)
+            if match:
+                self.requests['courses'] += 1
+                course_id = str(next(self.ids))
+                self.courses[course_id] = {'title': form.get('goal[name]', [''])[0], 'items': {}}
+                body = '$(".modal").modal("hide"); window.location = "/custom/courses/{id}";'.format(id=course_id)
+                return 200, brotlicffi.compress(body.encode('utf-8'))
+            match = ITEM_PATH.match(path)
+            if match:
+                self.requests['items'] += 1
+                course = self.courses.get(match[1])
+                if course is None:
+                    return 404, b''
+                item_id = next(self.ids)
+                course['items'][str(item_id)] = {'word': form.get('item[cue][text]', [''])[0], 'sentences': 0}
+                return 200, brotlicffi.compress(json.dumps({'id': item_id}).encode('utf-8'))
+            match = SENTENCE_PATH.match(path)
+            if match:
+                self.requests['sentences'] += 1
+                item = self.courses.get(match[1], {}).get('items', {}).get(match[2])
+                if item is None:
+                    return 404, b''
+                item['sentences'] += 1
+                return 200, brotlicffi.compress(json.dumps({'id': next(self.ids)}).encode('utf-8'))
+            return 404, b''
+
+    # Works out the response to a get of one of the listings. Returns (status code, body)
+    def handle_get(self, path: str) -> tuple:
+        if self.latency > 0:
+            time.sleep(self.latency)
+        url = urllib.parse.urlsplit(path)
+        page = int(urllib.parse.parse_qs(url.query).get('page', ['1'])[0])
+        with self.lock:
+            if self.error_rate > 0 and random.random() < self.error_rate:
+                self.requests['errors'] += 1
+                return 503, b''
+            if COURSE_PATH.match(url.path):
+                self.requests['listings'] += 1
+                key, listing = 'courses', [{'id': course_id, 'title': course['title']} for course_id, course in self.courses.items()]
+            else:
+                match = ITEM_PATH.match(url.path)
+                if not match or match[1] not in self.courses:
+                    return 404, b''
+                self.requests['listings'] += 1
+                key, listing = 'items', [{'id': int(item_id), 'word': item['word'], 'sentences': item['sentences']}
+                                         for item_id, item in self.courses[match[1]]['items'].items()]
+            start = (page - 1) * LIST_PAGE_SIZE
+            next_page = page + 1 if start + LIST_PAGE_SIZE < len(listing) else None
+            body = {key: listing[start:start + LIST_PAGE_SIZE], 'next_page': next_page}
+            return 200, brotlicffi.compress(json.dumps(body, ensure_ascii=False).encode('utf-8'))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.requests)
+
+    def start(self) -> 'FakeIKnowServer':
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='fake-iknow', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a fake iKnow server to import into. Point "base_url" in generation_info.json at it')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every request takes')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that fail with a 503')
+    args = parser.parse_args()
+    server = FakeIKnowServer(port=args.port, latency=args.latency, error_rate=args.error_rate)
+    print('Fake iKnow listening on ' + server.url)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        print(server.stats())
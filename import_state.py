@@ -0,0 +1,42 @@
+import os # for putting an account's files in its own directory
+import threading # for telling a running import to stop
+from journal import Journal
+from metrics import Metrics
+from planner import DedupIndex
+from records import CourseTable
+
+
+# Everything a single account's import keeps track of while it runs. Each account gets its own, so
+# several accounts can import side by side in one process without treating each other's words as
+# duplicates or writing to each other's prior_results.json.
+# state_dir is where its prior_results.json, journal and metrics go - the current directory by default.
+class ImportState:
+    def __init__(self, state_dir: str = '', name: str = ''):
+        self.state_dir = state_dir
+        self.name = name
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        # Store the words we add during this round
+        self.added = set()
+        # Store words we've added in prior runs (comes from prior_results.json). The keys are the words
+        self.previously_added = {}
+        # Words/samples we failed to add this round
+        self.failed_to_add = [] # FailedItems
+        self.failed_to_add_sample = [] # FailedSamples
+        # One CourseRef per course we add to, shared by all its words and failures
+        self.courses = CourseTable()
+        # Which words we're uploading this round, keyed on their normalized word & reading
+        self.dedup_index = DedupIndex()
+        # Every course, item, sentence and failure gets written here as it happens.
+        # prior_results.json is the compacted snapshot of it.
+        self.journal = Journal(self.path('prior_results.json'), self.path('prior_results.journal'))
+        # Where the time goes during an import, and how every request went. Written out next to prior_results.json
+        self.metrics = Metrics()
+        # What's in iKnow, if we checked (see --reconcile). Kept up to date with what we add
+        self.remote_index = None
+        # Set to stop the import early, like ctrl+c does for a single account
+        self.stopping = threading.Event()
+
+    # Where a file belonging to this account lives
+    def path(self, filename: str) -> str:
+        return os.path.join(self.state_dir, filename) if self.state_dir else filename
@@ -1,13 +1,50 @@
+# Kakasi's dictionaries, requests, brotli and the kindle converter are only loaded once a run needs them,
+# so runs that exit early (bad config, nothing new to upload) start up fast
+from __future__ import annotations
 import json # for reading response & our kindle data
-import requests # for posting to iKnow
-import urllib # For encoding strings to url strings
-import pykakasi # For transliterating kanji->kana
-import brotlicffi # For decompressing responses
-from jp_kindle_lookup_to_json.kindle_to_json import create_json_from_db
-import sys, re, signal
+import urllib.parse # For encoding strings to url strings
+from typing import TYPE_CHECKING
+from upload_engine import UploadEngine # For uploading words concurrently
+from transliteration_cache import TransliterationCache # For only transliterating each sentence once
+from preprocess import Preprocessor, make_pool # For transliterating/encoding on every core ahead of the uploads
+from kindle_stream import stream_books # For reading the kindle data a book/word at a time
+from vocab_sync import VocabSync # For only converting lookups we haven't seen before
+from import_state import ImportState # For keeping each account's import separate
+from account_settings import AccountSettings # For handing an account's login and limits around in one go
+from records import Word, CourseRef, FailedItem, FailedSample # For keeping words and failures compact
+from remote_index import RemoteIndex, reconcile_results # For checking what's really in iKnow
+from metrics import format_duration
+from planner import BAD_DATA, UPLOAD, COURSE_SIZE, DedupIndex, ImportPlan, plan_import # For working out what to upload up front
+import sys, re, os, argparse, itertools, time, threading, contextlib, sqlite3
+from concurrent.futures import ThreadPoolExecutor, wait
+if TYPE_CHECKING:
+    import requests
+    from transport import IKnowTransport
 
-# Initialize kakasi
-kks = pykakasi.kakasi()
+# requests.codes.ok, without having to load requests to find out
+HTTP_OK = 200
+
+# Kakasi takes a good half second to load its dictionaries, so it's only created
+# the first time a sentence actually needs converting
+kks = None
+kks_lock = threading.Lock()
+
+def get_kakasi():
+    global kks
+    if kks is None:
+        with kks_lock:
+            if kks is None:
+                import pykakasi # For transliterating kanji->kana
+                kks = pykakasi.kakasi()
+    return kks
+
+# Converts a sentence to hiragana. Raises if kakasi can't handle it
+def convert_sentence(sentence: str) -> str:
+    return ''.join(item['hira'] for item in get_kakasi().convert(sentence))
+
+# Kakasi is the main CPU cost of an import, so every sentence goes through this cache.
+# It's kept on disk in transliteration_cache.db so later runs (and retries) don't redo the work.
+trans_cache = TransliterationCache()
 
 # Setup the parts of speech that iKnow recognizes
 valid_parts_of_speech = set({
@@ -51,158 +88,421 @@ pos_map = {
     'none': 'NONE'
 }
 
-# Define some constants
-BAD_DEF = 'NO DEFINITION FOUND'
-BAD_READING = 'NO READING FOUND'
-# Store the words we add during this round
-added = set()
-# Store words we've added in prior runs (comes from prior_results.json)
-previously_added = set()
-# List of dicts storing info on word/samples we failed to add
-failed_to_add = [] # contains dicts mapping {"course", "course_id", "word"}
-failed_to_add_sample = [] # contains dicts mapping {"course", "course_id", "word", "word_id", "sentence"}
-course_info = [] # contains dicts mapping {"title", "cur_course_id", "number", "items"}
-
-# Used for when we decide to overwrite what ctrl+c does
-original_sigint = signal.getsignal(signal.SIGINT)
-
-def convert_json_to_items(cookie_string: str, csrf_token: str, import_json: str):
-    # Try to open the prior results JSON file & add the already-added words to our
-    # previously_added set to ensure we don't add the same words multiple times
-    existing_courses = {} # Map of title to info as a tuple. cur id, cur #, cur items
-    existing_course_titles = set() # Set of titles
+# Uploads everything in the kindle data JSON file to iKnow, with the account's login and limits in settings.
+# With retry_failures, only the failures stored in prior_results.json are retried instead - the kindle data
+# (if given) is only used to fill in failures recorded by older versions that don't have all the word's data.
+# With reconcile, what's already in the account's iKnow courses is fetched first (or read from remote_index.json if
+# that's less than settings.remote_index_max_age seconds old), and anything prior_results.json didn't know about is added to it.
+# state holds the account's results and progress - a fresh one in the current directory if not given.
+# preprocess_pool is a process pool to share with other imports running at the same time, if any.
+# Returns False if the import was interrupted before it finished.
+def convert_json_to_items(settings: AccountSettings, import_json: str, dry_run: bool = False, retry_failures: bool = False,
+                          state: ImportState = None, preprocess_pool=None, reconcile: bool = False) -> bool:
+    if state is None:
+        state = ImportState()
+    metrics = state.metrics
+    prior_results = load_prior_results(settings, dry_run, reconcile, state)
+    if prior_results is None:
+        return False
+    existing_courses, provisioned = course_progress(prior_results)
+    if retry_failures:
+        # Rebuild books out of the words we failed to add, and re-attach the missing sample
+        # sentences to items that are already in iKnow
+        failures = itertools.chain(prior_results.not_added.values(), prior_results.no_sample.values())
+        known_words = lookup_words(import_json, [failure.word.word for failure in failures if not failure.word.complete()])
+        retry_books = failed_books(prior_results.not_added.values(), known_words)
+        retry_samples = failed_samples(prior_results.no_sample.values(), known_words)
+        read_books = lambda: iter(retry_books)
+        print('Retrying {items} words and {samples} sample sentences'.format(
+            items=sum(len(book['words']) for book in retry_books), samples=len(retry_samples)))
+    else:
+        # Not-added and no-sample get retried here anyway, assuming the same kindle_json file is provided.
+        # They stay in prior_results.json until they're added successfully.
+        retry_samples = []
+        read_books = lambda: read_kindle_books(import_json)
+
+    # Work out exactly what we're going to upload before making a single request
+    with metrics.stage('plan'):
+        plan = plan_import(read_books(), existing_courses, state.dedup_index.fresh(), provisioned)
+    plan.print_summary(len(retry_samples))
+    if dry_run:
+        return True
+    if plan.words() == 0 and not retry_samples:
+        print('Nothing new to upload.')
+        return True
+
+    drop_cached_remote_index(state)
+    # There's something to upload, so now's the time to load the network side of things
+    uploader = Uploader(settings, state, preprocess_pool)
+    finished = True
     try:
-        with open('prior_results.json', 'r', encoding='utf-8') as pr:
-            json_data = json.load(pr)
-            for word in json_data.get('added', []):
-                previously_added.add(word)
-            for course in json_data.get('courses', []):
-                # Note: all these fields must exist. Hence the non-safe access, I want this to crash
-                # now if the prior_results json is bad
-                title = course['title']
-                existing_course_titles.add(title)
-                existing_courses[title] = (course['cur_course_id'], course['number'], course['items'])
-            # We don't care about not-added or no-sample, since we would theoretically be retrying those
-            # items here, assuming the same kindle_json file is provided.
-            # If you care about the data there, save it before re-running!
-    except FileNotFoundError:
-        print('No prior results JSON found. Skipping.')
-    
-    # Setup a handler for ctrl+c such that we always generate the results json at this point
-    # TODO: this doesn't actually seem to work as intended
-    signal.signal(signal.SIGINT, create_results_json)
-
-    # Define our headers that we'll re-use for most requests
-    headers = {
-        'Host': 'iknow.jp',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:86.0) Gecko/20100101 Firefox/86.0',
-        'Accept': 'application/json, text/javascript, */*; q=0.01',
-        'Accept-Language': 'en-US,en;q=0.5',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'Referer': 'https://iknow.jp/home',
-        'X-CSRF-Token': csrf_token,
-        'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
-        'X-Requested-With': 'XMLHttpRequest',
-        'Content-Length': '265',
-        'Origin': 'https://iknow.jp',
-        'DNT': '1',
-        'Connection': 'keep-alive',
-        'Cookie': cookie_string,
-        'Sec-GPC': '1',
-        'TE': 'Trailers',
-    }
+        with uploader:
+            # The plan already read through the kindle data once - this is the second time, streamed again a book
+            # at a time rather than keeping every book from the first read in memory
+            upload_plan(plan, read_books(), existing_courses, provisioned, retry_samples, uploader, state)
+    except KeyboardInterrupt:
+        # Everything that finished uploading is already in the journal, so there's nothing to lose here.
+        # The engine throws away whatever was still queued on the way out.
+        print('Interrupted - stopping the import')
+        finished = False
+    # Have added all words we wanted to from import_json
+    finish_import(uploader, finished, state)
+    return finished
+
+# Folds anything left in the journal (say from a run that crashed, or was ctrl+c'd) into
+# prior_results.json, and uses the already-added words as state's previously_added set
+# to ensure we don't add the same words multiple times.
+# With reconcile it's checked against what's really in iKnow first (see convert_json_to_items).
+# A dry run only reads them, so it doesn't touch anything on disk.
+# Returns the results (see Journal.load), or None if reconcile couldn't find out what's in iKnow
+def load_prior_results(settings: AccountSettings, dry_run: bool, reconcile: bool, state: ImportState):
+    journal = state.journal
+    prior_results = journal.load() if dry_run or reconcile else journal.compact()
+    if reconcile:
+        # prior_results.json may be missing or behind, so check against what's really in iKnow
+        remote_index = load_remote_index(settings, state, cache=not dry_run)
+        if remote_index is None:
+            print('Couldn\'t find out what\'s already in iKnow, so not importing anything')
+            return None
+        found = reconcile_results(remote_index, prior_results, None if dry_run else journal)
+        print('iKnow has {courses} courses with {items} items. {words} words and {new_courses} courses weren\'t in {path} yet'.format(
+            courses=len(remote_index.courses), items=remote_index.items(), words=found['words'], new_courses=found['courses'],
+            path=journal.snapshot_path))
+        if not dry_run:
+            prior_results = journal.compact()
+        state.remote_index = remote_index
+    state.previously_added = prior_results.added
+    state.dedup_index = DedupIndex(prior_results.added)
+    return prior_results
+
+# Returns where each book has got to in the prior results, as a map of title to info as a tuple (cur id, cur #, cur items),
+# and the courses a previous run made ahead of time but never got round to using, as a map of (title, #) -> course id
+def course_progress(prior_results) -> tuple:
+    existing_courses = {}
+    for course in prior_results.courses.values():
+        # Note: all these fields must exist. Hence the non-safe access, I want this to crash
+        # now if the prior_results json is bad
+        existing_courses[course['title']] = (course['cur_course_id'], course['number'], course['items'])
+    provisioned = {(course['title'], course['number']): course['course_id'] for course in prior_results.provisioned.values()}
+    return existing_courses, provisioned
 
+# Whatever's cached of what's in iKnow won't include what we're about to add. If we have the index
+# in hand it's kept up to date and saved again at the end, otherwise it has to be fetched next time
+def drop_cached_remote_index(state: ImportState) -> None:
+    remote_index_path = state.path('remote_index.json')
+    if os.path.exists(remote_index_path):
+        os.remove(remote_index_path)
+
+# Sets up everything an account's requests go through: the engine that runs them (and limits how fast),
+# the scheduler that retries them and the session that sends them. Returns (engine, retry, transport).
+# Close the transport once the engine's done with it
+def open_connection(settings: AccountSettings, state: ImportState) -> tuple:
+    from transport import IKnowTransport # For sharing one pooled session across all requests
+    from retry_scheduler import RetryScheduler # For retrying transient failures
+    engine = UploadEngine(settings.workers, settings.requests_per_second)
+    # Transient failures are retried with backoff, and we slow down if iKnow starts erroring a lot
+    retry = RetryScheduler(engine.limiter)
+    # Every request goes through one pooled, keep-alive session shared by all the workers
+    transport = IKnowTransport(settings.cookies, settings.csrf_token, pool_size=settings.workers, timeout=settings.timeout,
+                               limiter=engine.limiter, base_url=settings.base_url, retry=retry, metrics=state.metrics)
+    return engine, retry, transport
+
+# The network side of an import: the upload engine, the HTTP session every request goes through and
+# the preprocessing workers. Use it as a context manager, or close it when done.
+# Watch mode keeps one open between syncs, so its connections (and worker processes) stay warm
+class Uploader:
+    def __init__(self, settings: AccountSettings, state: ImportState, preprocess_pool=None):
+        self.engine, self.retry, self.transport = open_connection(settings, state)
+        # Transliteration and payload encoding happen on a process pool, ahead of the upload workers
+        self.preprocessor = Preprocessor(trans_cache, settings.preprocess_workers, state.metrics, preprocess_pool)
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(cancel=exc_type is not None)
+
+    # Waits for the workers to finish, or throws away whatever's still queued with cancel, then closes the session
+    def close(self, cancel: bool = False) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        if cancel:
+            self.engine.cancel()
+        self.engine.shutdown()
+        self.preprocessor.close(cancel=cancel)
+        self.transport.close()
+
+# Makes every course the plan needs, then uploads the books (and re-attaches retry_samples) into them.
+# books must be the same books, in the same order, the plan was made from. existing_courses is left holding
+# where each book got to. Returns the map of (title, #) -> course id that was uploaded into
+def upload_plan(plan: ImportPlan, books, existing_courses: dict, provisioned: dict, retry_samples: list, uploader: Uploader,
+                state: ImportState) -> dict:
+    metrics = state.metrics
+    # Every course the plan needs gets made now, all at once, so uploading never has to wait on one
+    with metrics.stage('provision courses'):
+        course_ids = provision_courses(plan, provisioned, uploader.engine, uploader.transport, state)
+    metrics.start_progress(plan.words() + len(retry_samples))
+    with metrics.stage('upload'):
+        upload_books(books, existing_courses, course_ids, uploader.engine, uploader.preprocessor, uploader.transport, state)
+        retry_sample_sentences(retry_samples, uploader.engine, uploader.preprocessor, uploader.transport, state)
+    return course_ids
+
+# Closes the uploader, prints how it went and writes import_metrics.json (and the remote index, if we have it).
+# Then folds the journal into prior_results.json
+def finish_import(uploader: Uploader, finished: bool, state: ImportState) -> None:
+    metrics = state.metrics
+    uploader.close(cancel=not finished)
+    stats = uploader.transport.stats()
+    print('Made {requests} requests: {reused} on reused connections, {new} new connections'.format(
+        requests=stats['requests'], reused=stats['reused_connections'], new=stats['new_connections']))
+    retry_stats = uploader.retry.stats()
+    print('Retried {retries} requests, slowed down {slowdowns} times because of errors'.format(
+        retries=retry_stats['retries'], slowdowns=retry_stats['slowdowns']))
+    cache_stats = trans_cache.stats()
+    print('Transliteration cache: {hits} of {lookups} lookups hit ({rate:.0%}), {misses} sentences converted'.format(
+        hits=cache_stats['memory_hits'] + cache_stats['disk_hits'], lookups=cache_stats['lookups'],
+        rate=cache_stats['hit_rate'], misses=cache_stats['misses']))
+    trans_cache.close()
+    metrics.print_summary()
+    metrics_path = state.path('import_metrics.json')
+    metrics.write(metrics_path, {'finished': finished, 'connections': stats, 'retries': retry_stats, 'transliteration_cache': cache_stats})
+    print('Wrote metrics to ' + metrics_path)
+    if state.remote_index is not None:
+        state.remote_index.save(state.path('remote_index.json'))
+    create_results_json(state)
+
+# Streams the books out of a kindle data JSON file, with each word as a Word
+def read_kindle_books(import_json: str):
     with open(import_json, 'r', encoding='utf-8') as f:
-        json_data = json.load(f)
-        for cur_book in json_data.get('books', []):
-            cur_title = cur_book['title']
-            # Grab info from JSON if exists, otherwise default to initialized values
-            course_id, cur_course_counts, cur_item_count = existing_courses.get(title, ('', 0, 0))
+        for book in stream_books(f):
+            yield {'title': book['title'], 'words': map(Word.from_dict, book['words'])}
+
+# Finds the full data for the given words in the kindle data JSON file, if there is one.
+# Returns a map of word -> Word
+def lookup_words(import_json: str, words: list) -> dict:
+    needed = set(words)
+    found = {}
+    if not needed or not import_json:
+        return found
+    try:
+        for book in read_kindle_books(import_json):
+            for word in book['words']:
+                if word.word in needed and word.word not in found:
+                    found[word.word] = word
+    except FileNotFoundError:
+        print('Couldn\'t find ' + import_json + ' to look up old failures in')
+    return found
+
+# Turns the words we failed to add back into books, grouped by the book they came from
+def failed_books(failures, known_words: dict) -> list:
+    books = {}
+    for failure in failures:
+        if failure.word.complete():
+            word = failure.word
+        elif failure.word.word in known_words:
+            word = known_words[failure.word.word]
+        else:
+            print('No data to retry ' + failure.word.word + ' with - give me the kindle data it came from')
+            continue
+        books.setdefault(failure.course.title, []).append(word)
+    return [{'title': title, 'words': words} for title, words in books.items()]
+
+# Returns the FailedSample for every missing sample sentence we can re-attach
+def failed_samples(failures, known_words: dict) -> list:
+    samples = []
+    for failure in failures:
+        if not failure.word.sample:
+            # The word never had a sample sentence, so there's nothing to add
+            continue
+        if not failure.word_id:
+            print('Don\'t know the item id for ' + failure.word.word + ', so can\'t add its sample sentence')
+            continue
+        if not failure.word.complete():
+            # Only the sample and definition go into the sentence payload
+            known = known_words.get(failure.word.word)
+            failure.word.definition = known.definition if known else ''
+        samples.append(failure)
+    return samples
+
+# Adds the sample sentences we failed to add last time to items already in iKnow, without re-uploading the items
+def retry_sample_sentences(samples: list, engine: UploadEngine, preprocessor: Preprocessor, transport: IKnowTransport, state: ImportState) -> None:
+    prepared_words = preprocessor.prepare(sample.word for sample in samples)
+    for sample, prepared in zip(samples, prepared_words):
+        if state.stopping.is_set():
+            raise KeyboardInterrupt
+        if prepared['trans'] == '':
+            record_failed_sample(sample.course, sample.word, sample.word_id, state)
+            state.metrics.word_done()
+        else:
+            engine.submit(upload_sample, sample, prepared['sentence_payload'], transport, state)
+    engine.wait()
+
+# Re-attaches a single sample sentence. Runs on an upload engine worker
+def upload_sample(sample: FailedSample, sentence_payload: str, transport: IKnowTransport, state: ImportState) -> None:
+    try:
+        add_sample_sentence(sample.word, sentence_payload, sample.course, sample.word_id, transport, state)
+    finally:
+        state.metrics.word_done()
+
+# Creates every course the plan needs, concurrently, retrying the ones that fail.
+# Returns a map of (title, #) -> course id for every course ready to be added to, including ones
+# provisioned by earlier runs. Courses we still couldn't make are left out.
+def provision_courses(plan: ImportPlan, provisioned: dict, engine: UploadEngine, transport: IKnowTransport, state: ImportState, attempts: int = 3) -> dict:
+    course_ids = dict(provisioned)
+    missing = plan.new_courses()
+    for attempt in range(attempts):
+        if not missing:
+            break
+        if attempt > 0:
+            print('Retrying ' + str(len(missing)) + ' courses we couldn\'t create')
+            time.sleep(2 ** attempt)
+        futures = {(title, number): engine.submit(create_new_course, title, number, transport, state) for title, number in missing}
+        missing = []
+        for (title, number), future in futures.items():
+            course_id = future.result()
             if course_id == '':
-                # Need to make a new course and get the id for it.
-                course_id = create_new_course(cur_title, cur_course_counts, headers)
-                # Check return value to see if we actually made a new course successfully
-                if course_id == '':
-                    print('Unable to make a first course for ' + cur_title + '. Moving onto new book')
-                    continue
-            cur_course_info = {
-                'title' : cur_title,
-                'cur_course_id' : course_id,
-                'number': cur_course_counts,
-                'items': cur_item_count,
-            }
-            course_info.append(cur_course_info)
-            book_words = cur_book['words']
-            cur_course = cur_title + ' ' + str(cur_course_counts)
-            # NOTE: This is probably a good place to implement threading, but I don't want to
-            # hit iKnow too hard since the API isn't public and I don't want to get blocked
-            for word in book_words:
-                if cur_item_count >= 100:
-                    # Create a new course and roll over.  iKnow recommends courses have a max of 100 items
-                    cur_course_counts += 1
-                    new_course_id = create_new_course(cur_title, cur_course_counts, headers)
-                    # Check return value to see if we actually made a new course successfully
-                    # If not, we'll try again the next run. TODO: Is this a good idea?
-                    if new_course_id == '':
-                        print('Unable to make a new course for ' + cur_title + '. Adding to existing course')
-                        cur_course_counts -= 1
-                    else:
-                        course_id = new_course_id
-                        cur_item_count = 0
-                    cur_course = cur_title + ' ' + str(cur_course_counts)
-                    # Update our course info map
-                    cur_course_info['cur_course_id'] = course_id
-                    cur_course_info['number'] = cur_course_counts
-
-                # Create the JSON object to send
-                word_id = create_new_item(cur_course, course_id, word, headers)
-                if word_id == '':
-                    # Couldn't create the item - move on to the next
-                    continue
-                cur_item_count += 1
-                # In preperation for sending sample sentence, create the kana-only version of the sample
-                trans = create_transliteration(word)
-                # Only add sample sentence if we managed to transliterate something
-                if trans == '':
-                    no_sample_dict = {
-                        'course': course,
-                        'course_id': course_id,
-                        'word': word['word'],
-                        'word_id': word_id,
-                        'sentence': word['sample'],
-                    }
-                    failed_to_add_sample.append(no_sample_dict)
-                else:
-                    add_sample_sentence(word, trans, cur_course, course_id, word_id, headers)
-            # End of words loop
-            # Finish updating our course info
-            cur_course_info['cur_course_id'] = course_id
-            cur_course_info['number'] = cur_course_counts
-            cur_course_info['items'] = cur_item_count
-        # End of books loop
-    # Have added all words we wanted to from import_json
-    create_results_json()
-
-# Creates the final results json file
-def create_results_json():
-    # Remap the exit signal to default
-    signal.signal(signal.SIGINT, original_sigint)
-    print('Writing out results to prior_results.json')
-    # Next lets create the JSON file for what words we've added and haven't
-    results = {} # head of the json object we will write
-    all_added = list(added)
-    all_added.extend(list(previously_added))
-    results['courses'] = course_info
-    results['added'] = all_added
-    results['not-added'] = failed_to_add
-    results['no-sample'] = failed_to_add_sample
-    with open('prior_results.json', 'w+', encoding='utf-8') as j:
-        j.write(json.dumps(results, indent=4, ensure_ascii=False))
-    # This should be the final call of this script.
-    exit(0)
+                missing.append((title, number))
+            else:
+                course_ids[(title, number)] = course_id
+                # Remember it straight away, so if we crash before using it we won't make it again
+                state.journal.provisioned(title, number, course_id)
+                if state.remote_index is not None:
+                    state.remote_index.add_course(course_id, title + ' ' + str(number), {})
+                state.metrics.count('courses created')
+    for title, number in missing:
+        print('Unable to make course ' + title + ' ' + str(number) + '. Its words will be recorded as failures, for --retry-failures')
+        state.metrics.count('courses failed')
+    return course_ids
 
-# Adds a sample sentence for a word already in iKnow
-def add_sample_sentence(word: dict, trans: str, course: str, course_id: str, word_id: str, headers: dict) -> None:
+# Uploads every book in the kindle data into the courses made by provision_courses.
+# Books (and their words) can be any iterable, so they can be streamed in
+def upload_books(books, existing_courses: dict, course_ids: dict, engine: UploadEngine, preprocessor: Preprocessor, transport: IKnowTransport,
+                 state: ImportState) -> None:
+    for cur_book in books:
+        cur_title = cur_book['title']
+        # Grab info from JSON if exists, otherwise default to initialized values
+        course_id, cur_course_counts, cur_item_count = existing_courses.get(cur_title, ('', 0, 0))
+        # Filter out duplicates and bad data up front, so only words that will
+        # actually be uploaded take up a slot in a course (or any CPU time).
+        # The dedup index sees words in the same order the planner did, so it makes the same calls -
+        # and so needs exactly the courses it planned for.
+        # This is lazy - words are only read and checked as the preprocessor asks for them
+        start_course = state.courses.get(cur_title + ' ' + str(cur_course_counts), course_id)
+        book_words = (word for word in cur_book['words'] if should_upload(start_course, word, state))
+        first_word = next(book_words, None)
+        if first_word is None:
+            # Nothing to add for this book
+            continue
+        book_words = itertools.chain([first_word], book_words)
+        if course_id == '':
+            course_id = course_ids.get((cur_title, cur_course_counts), '')
+            if course_id != '':
+                state.journal.course(cur_title, course_id, cur_course_counts, cur_item_count)
+        # Only as many words as the courses we have can take get uploaded. Rather than overfill a course,
+        # the rest are recorded as failures (see below), so --retry-failures adds them once their course exists
+        room, missing_number = 0, cur_course_counts
+        if course_id != '':
+            room = max(0, COURSE_SIZE - cur_item_count)
+            missing_number += 1
+            while (cur_title, missing_number) in course_ids:
+                room += COURSE_SIZE
+                missing_number += 1
+        cur_course = state.courses.get(cur_title + ' ' + str(cur_course_counts), course_id)
+        # islice only reads as many words as it hands out, so the rest are still in book_words afterwards
+        for prepared in preprocessor.prepare(itertools.islice(book_words, room)):
+            if state.stopping.is_set():
+                # Stop the same way ctrl+c would
+                raise KeyboardInterrupt
+            if cur_item_count >= COURSE_SIZE:
+                # Roll over into the next course.  iKnow recommends courses have a max of 100 items
+                cur_course_counts += 1
+                course_id = course_ids[(cur_title, cur_course_counts)]
+                cur_item_count = 0
+                state.journal.course(cur_title, course_id, cur_course_counts, cur_item_count)
+                cur_course = state.courses.get(cur_title + ' ' + str(cur_course_counts), course_id)
+
+            # The course is decided here, at submission time, so the word lands in the
+            # right course no matter when a worker gets around to uploading it
+            engine.submit(upload_word, cur_course, prepared, transport, state)
+            cur_item_count += 1
+        # End of words loop
+        missing_course = state.courses.get(cur_title + ' ' + str(missing_number), '')
+        skipped = 0
+        for word in book_words:
+            record_failed_item(missing_course, word, state)
+            state.metrics.word_done()
+            skipped += 1
+        if skipped:
+            print('No course {course} to add to, so {skipped} of its words were recorded as failures'.format(
+                course=missing_course.name, skipped=skipped))
+        # In case the same book shows up again further on in the kindle data
+        existing_courses[cur_title] = (course_id, cur_course_counts, cur_item_count)
+    # End of books loop
+    engine.wait()
+
+# Checks whether a word still needs uploading, and claims it for upload if so.
+# Records words with bad data as failures.
+def should_upload(course: CourseRef, word: Word, state: ImportState) -> bool:
+    # Don't try to add words we've added in the past, or that we've already seen this round
+    outcome = state.dedup_index.check(word)
+    if outcome == BAD_DATA:
+        # The kindle json couldn't figure these out, let's not add them and move on.
+        print('Either bad reading or def for: ' + word.word)
+        record_failed_item(course, word, state)
+    return outcome == UPLOAD
+
+# Uploads a single prepared word and its sample sentence. Runs on an upload engine worker.
+# Returns True if the item itself was created.
+def upload_word(course: CourseRef, prepared: dict, transport: IKnowTransport, state: ImportState) -> bool:
+    try:
+        word = prepared['word']
+        word_id = create_new_item(course, word, prepared['item_payload'], transport, state)
+        if word_id == '':
+            # Couldn't create the item - move on to the next
+            return False
+        # Only add sample sentence if we managed to transliterate something
+        if prepared['trans'] == '':
+            record_failed_sample(course, word, word_id, state)
+        else:
+            add_sample_sentence(word, prepared['sentence_payload'], course, word_id, transport, state)
+        return True
+    except Exception:
+        # Blew up part way, so the word may be neither in iKnow nor recorded as a failure (see all_recorded)
+        state.metrics.count('words unrecorded')
+        raise
+    finally:
+        state.metrics.word_done()
+
+# Whether every word the import got to was either added or recorded as a failure. If not, the
+# vocab.db lookups they came from mustn't be marked as synced, or nothing would ever try them again
+def all_recorded(state: ImportState) -> bool:
+    return state.metrics.counter('words unrecorded') == 0
+
+# Compacts the journal into the final results json file
+def create_results_json(state: ImportState):
+    print('Writing out results to ' + state.journal.snapshot_path)
+    results = state.journal.compact()
+    print('{added} words added in total, {not_added} not added, {no_sample} without a sample sentence'.format(
+        added=len(results.added), not_added=len(results.not_added), no_sample=len(results.no_sample)))
+
+# Records a word we couldn't add as an item - will process later
+def record_failed_item(course: CourseRef, word: Word, state: ImportState) -> None:
+    failure = FailedItem(course, word)
+    state.failed_to_add.append(failure)
+    state.journal.failed_item(failure)
+    state.metrics.count('items failed')
+
+# Records a word whose sample sentence we couldn't add - will process later
+def record_failed_sample(course: CourseRef, word: Word, word_id: str, state: ImportState) -> None:
+    failure = FailedSample(course, word, word_id)
+    state.failed_to_add_sample.append(failure)
+    state.journal.failed_sample(failure)
+    state.metrics.count('sentences failed')
+
+# Builds the url-encoded form payload for adding a word's sample sentence
+def build_sentence_payload(word: Word, trans: str) -> str:
     '''
 And for the actual adding of the example sentence, here's the form:
 
@@ -229,82 +529,45 @@ utf8=%E2%9C%93&sentence_package%5Bsentence%5D%5Btext%5D=
     en
 &sentence_package%5Bsound%5D%5Burl%5D=&sentence_package%5Bimage_url%5D=&commit=Add
     '''
-    encoded_sample = urllib.parse.quote_plus(word['sample'], encoding='utf-8')
+    encoded_sample = urllib.parse.quote_plus(word.sample, encoding='utf-8')
     encoded_trans = urllib.parse.quote_plus(trans, encoding='utf-8')
-    definition = urllib.parse.quote_plus(word['definition'], encoding='utf-8')
-    add_sentence_url = 'https://iknow.jp/custom/courses/{course_id}/items/{word_id}/sentences'.format(course_id=course_id, word_id=word_id)
+    definition = urllib.parse.quote_plus(word.definition, encoding='utf-8')
 
     sample_text = 'utf8=%E2%9C%93&sentence_package%5Bsentence%5D%5Btext%5D=' + encoded_sample
     sample_translit = '&sentence_package%5Bsentence%5D%5Btransliteration%5D=' + encoded_trans
     translation = '&sentence_package%5Bsentence%5D%5Blanguage%5D=ja&sentence_package%5Btranslation%5D%5Btext%5D=' + definition
     end = '&sentence_package%5Btranslation%5D%5Blanguage%5D=en&sentence_package%5Bsound%5D%5Burl%5D=&sentence_package%5Bimage_url%5D=&commit=Add'
 
-    sample_send_payload = sample_text + sample_translit + translation + end
+    return sample_text + sample_translit + translation + end
 
+# Adds a sample sentence for a word already in iKnow
+def add_sample_sentence(word: Word, sentence_payload: str, course: CourseRef, word_id: str, transport: IKnowTransport, state: ImportState) -> None:
+    add_sentence_url = transport.url('/custom/courses/{course_id}/items/{word_id}/sentences'.format(course_id=course.course_id, word_id=word_id))
     try:
-        res = requests.post(add_sentence_url, data=sample_send_payload, headers=headers)
-    except:
-        no_sample_dict = {
-            'course': course,
-            'course_id': course_id,
-            'word': word['word'],
-            'word_id': word_id,
-            'sentence': word['sample'],
-        }
-        failed_to_add_sample.append(no_sample_dict)
-        print('Couldn\'t add sample sentence for word: ' + word['word'] + ' - request failed.') 
+        res = transport.post(add_sentence_url, sentence_payload)
+    except Exception:
+        record_failed_sample(course, word, word_id, state)
+        print('Couldn\'t add sample sentence for word: ' + word.word + ' - request failed.') 
         print('Sample sentence is:')
-        print(word['sample'])
+        print(word.sample)
+        return
     res.encoding = 'utf-8'
-    if res.status_code != requests.codes.ok:
+    if res.status_code != HTTP_OK:
         # Mark as a word we couldn't add - will process later
-        no_sample_dict = {
-            'course': course,
-            'course_id': course_id,
-            'word': word['word'],
-            'word_id': word_id,
-            'sentence': word['sample'],
-        }
-        failed_to_add_sample.append(no_sample_dict)
-        print('Couldn\'t add sample sentence for word: ' + word['word'] + ' - bad request return code.') 
+        record_failed_sample(course, word, word_id, state)
+        print('Couldn\'t add sample sentence for word: ' + word.word + ' - bad request return code.') 
         print('Sample sentence is:')
-        print(word['sample'])
-
-# Create a transliteration for the sample sentence
-# Return empty string if we fail to transliterate
-def create_transliteration(word: dict) -> str:
-    try:
-        transliterated_sample = kks.convert(word['sample'])
-    except:
-        print('Failed to transliterate sample sentence for word:' + word['word'])
-        print(word['sample'])
-        return ''
-    trans = ''
-    for item in transliterated_sample:
-        trans += item['hira']
-    return trans
+        print(word.sample)
+    else:
+        state.journal.sentence(word.word, word_id)
+        state.metrics.count('sentences added')
 
-# Add a new item to a iKnow course
-# Returns empty string if we fail to create an item, or parse the response.
-def create_new_item(course: str, course_id: str, word: dict, headers: dict) -> str:
-    add_new_item_url = 'https://iknow.jp/custom/courses/{course_id}/items'.format(course_id=course_id)
-    if word['word'] in previously_added or word['word'] in added:
-        return ''
-    if word['definition'] == BAD_DEF or word['reading'] == BAD_READING:
-        # The kindle json couldn't figure these out, let's not add them and move on.
-        print('Either bad reading or def for: ' + word['word'])
-        fail_to_add_dict = {
-            'course': course,
-            'course_id': course_id,
-            'word': word['word']
-        }
-        failed_to_add.append(fail_to_add_dict)
-        return ''
-    cur_word = urllib.parse.quote_plus(word['word'], encoding='utf-8')
-    # Don't try to add words we've added in the past
-    reading = urllib.parse.quote_plus(word['reading'], encoding='utf-8')
-    definition = urllib.parse.quote_plus(word['definition'], encoding='utf-8')
-    pos_list = word['part_of_speech'].split(',')
+# Builds the url-encoded form payload for adding a word as a new item
+def build_item_payload(word: Word) -> str:
+    cur_word = urllib.parse.quote_plus(word.word, encoding='utf-8')
+    reading = urllib.parse.quote_plus(word.reading, encoding='utf-8')
+    definition = urllib.parse.quote_plus(word.definition, encoding='utf-8')
+    pos_list = word.part_of_speech.split(',')
     pos = 'NONE' # Default to none
     # TODO: This chunk doesn't seem to work - part of speech wasn't added for any of my uploads
     for pos in pos_list:
@@ -325,78 +588,94 @@ def create_new_item(course: str, course_id: str, word: dict, headers: dict) -> s
     '''
     cueString = 'item%5Bcue%5D%5Btext%5D={encodedCue}&item%5Bcue%5D%5Blanguage%5D={cueLang}&item%5Bcue%5D%5Btransliteration%5D={encodedCueTransliteration}&item%5Bcue%5D%5Bpart_of_speech%5D={cuePoS}'.format(encodedCue=cur_word, cueLang='ja', encodedCueTransliteration=reading, cuePoS=pos)
     responseString = '&item%5Bresponse%5D%5Btext%5D={responseText}&item%5Bresponse%5D%5Blanguage%5D={responseLang}'.format(responseText=definition, responseLang='en')
-    payload = cueString + responseString
     '''
     Example payload:
 item%5Bcue%5D%5Btext%5D=鼻歌&item%5Bcue%5D%5Blanguage%5D=jp&item%5Bcue%5D%5Btransliteration%5D=はなうた&item%5Bcue%5D%5Bpart_of_speech%5D=&item%5Bresponse%5D%5Btext%5D=humming, crooning&item%5Bresponse%5D%5Blanguage%5D=en
     '''
+    return cueString + responseString
+
+# iKnow brotli compresses its responses. If requests has already decompressed one for us
+# (it will if it can find a brotli module), the content is good as it is.
+# Raises ValueError if it really can't be decoded
+def decode_response(res: requests.Response, state: ImportState) -> bytes:
+    import brotlicffi # For decompressing responses
+    with state.metrics.stage('decompress responses'):
+        try:
+            return brotlicffi.decompress(res.content)
+        except brotlicffi.Error as e:
+            if 'br' in res.headers.get('Content-Encoding', ''):
+                return res.content
+            raise ValueError('Couldn\'t decompress response: ' + str(e))
+
+# Add a new item to a iKnow course
+# Returns empty string if we fail to create an item, or parse the response.
+def create_new_item(course: CourseRef, word: Word, item_payload: str, transport: IKnowTransport, state: ImportState) -> str:
+    add_new_item_url = transport.url('/custom/courses/{course_id}/items'.format(course_id=course.course_id))
+    # Duplicate and bad data checks happen in should_upload before the word gets here
     try:
-        res = requests.post(add_new_item_url, data=payload, headers=headers)
-    except:
-        fail_to_add_dict = {
-            'course': course,
-            'course_id': course_id,
-            'word': word['word']
-        }
-        failed_to_add.append(fail_to_add_dict)
-        print('Failed to post new word ' + word['word'])
+        res = transport.post(add_new_item_url, item_payload)
+    except Exception:
+        record_failed_item(course, word, state)
+        print('Failed to post new word ' + word.word)
         return ''
     # Handler for wierd bug I encountered where res came back as None- maybe just due to forced exit
     if not res:
-        fail_to_add_dict = {
-            'course': course,
-            'course_id': course_id,
-            'word': word['word']
-        }
-        failed_to_add.append(fail_to_add_dict)
-        print('Failed to post new word ' + word['word'] + ' - no response')
+        record_failed_item(course, word, state)
+        print('Failed to post new word ' + word.word + ' - no response')
         return ''
     res.encoding = 'utf-8'
-    if res.status_code != requests.codes.ok:
+    item_added = res.status_code == HTTP_OK
+    if not item_added:
         # Mark as a word we couldn't add
-        fail_to_add_dict = {
-            'course': course,
-            'course_id': course_id,
-            'word': word['word']
-        }
-        failed_to_add.append(fail_to_add_dict)
+        record_failed_item(course, word, state)
     else:
-        added.add(word['word'])
+        state.added.add(word.word)
     try:
-        res_decoded = brotlicffi.decompress(res.content)
-    except brotlicffi.Error as e:
+        res_decoded = decode_response(res, state)
+    except ValueError as e:
         print(str(e))
-        print('Could not decompress for word: ' + word['word'] + '\'s response')
+        print('Could not decompress for word: ' + word.word + '\'s response')
         print(str(res.content))
+        if item_added:
+            # We don't know its id, but the item is in iKnow - make sure we never add it again
+            state.journal.item(word.word, '', course.course_id)
+            state.metrics.count('items added')
+            if state.remote_index is not None:
+                state.remote_index.add_item(course.course_id, course.name, word.word, '')
         # Don't treat this as a failure to add. Just ensure that we don't try to add a sample sentence
         # and return a blank string
         return ''
     json_res = json.loads(res_decoded)
     # Grab the ID for the new flashcard we just added
     word_id = json_res['id']
+    if item_added:
+        state.journal.item(word.word, word_id, course.course_id)
+        state.metrics.count('items added')
+        if state.remote_index is not None:
+            state.remote_index.add_item(course.course_id, course.name, word.word, word_id)
     return word_id
 
 # Creates a new iKnow course
 # Returns an empty string if the request fails
-def create_new_course(title: str, count: int,  headers: dict) -> str:
+def create_new_course(title: str, count: int,  transport: IKnowTransport, state: ImportState) -> str:
     course_title = title + ' ' + str(count)
-    url = 'https://iknow.jp/custom/courses'
+    url = transport.url('/custom/courses')
     course = urllib.parse.quote_plus(course_title)
     payload = 'utf8=%E2%9C%93&goal%5Bname%5D={name}&language={lang}&translation_language={l}&goal%5Bicon_image_url%5D=&commit=Create'.format(name=course, lang='ja', l='en')
     try:
-        res = requests.post(url, data=payload, headers=headers)
-    except:
+        res = transport.post(url, payload)
+    except Exception:
         print('Failed to post new course ' + course_title)
         return ''
     res.encoding = 'utf-8'
-    if res.status_code != requests.codes.ok:
+    if res.status_code != HTTP_OK:
         # Mark as a word we couldn't add - will process later
         print('Unable to make a new course!!')
         print('Provided title: ' + course_title)
         return ''
     try:
-        res_decoded = brotlicffi.decompress(res.content)
-    except brotlicffi.Error:
+        res_decoded = decode_response(res, state)
+    except ValueError:
         print('Could not decompress our response from creating a course!')
         return ''
     # The response content is some jquery, which contains the course id
@@ -409,7 +688,286 @@ def create_new_course(title: str, count: int,  headers: dict) -> str:
         return course_id
 
 
+# Returns what's in every course in the account, from remote_index.json if we fetched it less than settings.remote_index_max_age
+# seconds ago, or fetched now (and cached, unless not cache) if not. Returns None if iKnow couldn't be read
+def load_remote_index(settings: AccountSettings, state: ImportState, cache: bool = True) -> RemoteIndex:
+    path = state.path('remote_index.json')
+    index = RemoteIndex.load(path, settings.base_url, settings.remote_index_max_age)
+    if index is not None:
+        print('Using the list of what\'s in iKnow from {age} ago. Delete {path} to fetch it again'.format(
+            age=format_duration(time.time() - index.fetched), path=path))
+        return index
+    print('Fetching what\'s already in your iKnow courses...')
+    engine, _, transport = open_connection(settings, state)
+    try:
+        with engine, state.metrics.stage('fetch remote index'):
+            index = fetch_remote_index(engine, transport, state)
+    finally:
+        transport.close()
+    if index is not None and cache:
+        index.save(path)
+    return index
+
+# Fetches the list of courses, then every course's items concurrently.
+# Returns None if any of it couldn't be fetched - half an index would make us upload duplicates
+def fetch_remote_index(engine: UploadEngine, transport: IKnowTransport, state: ImportState) -> RemoteIndex:
+    courses = fetch_listing('/custom/courses', 'courses', transport, state)
+    if courses is None:
+        print('Couldn\'t fetch the list of courses')
+        return None
+    futures = [(course, engine.submit(fetch_listing, '/custom/courses/{id}/items'.format(id=course['id']), 'items', transport, state))
+               for course in courses]
+    index = RemoteIndex(transport.base_url)
+    for course, future in futures:
+        items = future.result()
+        if items is None:
+            print('Couldn\'t fetch the items in ' + course['title'])
+            engine.cancel()
+            return None
+        index.add_course(course['id'], course['title'], {item['word']: str(item['id']) for item in items})
+    return index
+
+# Fetches every page of a listing, returning everything under key in each page, or None if a page couldn't be fetched.
+# Each page looks like {key: [...], "next_page": n}, where next_page is null on the last page
+def fetch_listing(path: str, key: str, transport: IKnowTransport, state: ImportState) -> list:
+    results = []
+    page = 1
+    while page:
+        url = transport.url(path + '?page=' + str(page))
+        try:
+            res = transport.get(url)
+        except Exception:
+            print('Failed to fetch ' + url)
+            return None
+        if res.status_code != HTTP_OK:
+            print('Failed to fetch ' + url + ' - got a ' + str(res.status_code))
+            return None
+        try:
+            listing = json.loads(decode_response(res, state))
+        except ValueError:
+            print('Couldn\'t read the response from ' + url)
+            return None
+        results.extend(listing[key])
+        page = listing.get('next_page')
+    return results
+
+
+# Runs the import for one account, as described by a generation_info.json style dict.
+# conversion_lock is held while turning a vocab.db into kindle data, for when accounts run side by side.
+# Returns False if the import didn't happen or didn't finish
+def run_account(info: dict, args, state: ImportState, preprocess_pool=None, conversion_lock=None) -> bool:
+    settings = AccountSettings.from_info(info)
+    kindle_data = info['kindle_data']
+    db_file = info['vocab_db']
+    # Name for the kindle the vocab.db came from, so each one remembers what it's already synced.
+    # Defaults to the vocab.db path
+    device = info.get('device', '')
+
+    if not kindle_data and not db_file and not args.retry_failures:
+        print('Supply a db path or kindle data path please.')
+        print('Note if you supply both we will not use the kindle_data and instead generate from the DB')
+        return False
+    if (not settings.cookies or not settings.csrf_token) and (not args.dry_run or args.reconcile):
+        print('Need cookies and csrf token to upload data.')
+        return False
+    if args.watch and (not db_file or args.dry_run or args.retry_failures):
+        print('--watch needs a vocab_db to watch, and can\'t be a dry run or a retry')
+        return False
+    sync = None
+    if db_file and not args.retry_failures:
+        # Only the lookups made since the last sync need converting and importing
+        sync = VocabSync(db_file, device, state.path('vocab_sync_state.json'))
+        if args.watch:
+            return watch_vocab_db(sync, settings, state, preprocess_pool, conversion_lock, args.reconcile)
+        kindle_data = convert_new_lookups(sync, state, conversion_lock)
+        if not kindle_data:
+            print('No new lookups in ' + db_file + ' since the last sync. Nothing to do!')
+            return True
+
+    print('Starting import process...')
+    finished = convert_json_to_items(settings, kindle_data, dry_run=args.dry_run, retry_failures=args.retry_failures, state=state,
+                                     preprocess_pool=preprocess_pool, reconcile=args.reconcile)
+    if sync and finished and not args.dry_run:
+        if all_recorded(state):
+            # Everything's imported (or recorded as a failure), so we don't need to look at these lookups again
+            sync.commit()
+        else:
+            print('Some words were neither added nor recorded as failures, so these lookups will be imported again next run')
+    return finished
+
+# Turns the lookups in vocab.db we haven't imported yet into kindle data.
+# Returns the kindle data's path, or '' if there weren't any new lookups
+def convert_new_lookups(sync: VocabSync, state: ImportState, conversion_lock=None) -> str:
+    new_lookups = sync.export_new_lookups(state.path('vocab_new.db'))
+    if new_lookups == 0:
+        return ''
+    print('Creating kindle data from ' + str(new_lookups) + ' new lookups in the vocab.db file...')
+    # The converter always writes kindle_data.json to the current directory, so only one account can use it at a time
+    with conversion_lock if conversion_lock else contextlib.nullcontext():
+        from jp_kindle_lookup_to_json.kindle_to_json import create_json_from_db
+        create_json_from_db(state.path('vocab_new.db'))
+        kindle_data = state.path('kindle_data.json')
+        if kindle_data != 'kindle_data.json':
+            os.replace('kindle_data.json', kindle_data)
+    return kindle_data
+
+# Changes whenever vocab.db (or its write-ahead log, if it has one) is written to. Just a couple of stats, so it's cheap to poll
+def db_fingerprint(db_file: str) -> tuple:
+    fingerprint = []
+    for path in (db_file, db_file + '-wal'):
+        try:
+            stat = os.stat(path)
+            fingerprint.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            fingerprint.append(None)
+    return tuple(fingerprint)
+
+# Keeps importing new lookups from vocab.db as they're made (checking every settings.watch_interval seconds),
+# until ctrl+c (or state.stopping).
+# vocab.db is only read when its size or modified time changes, and lookups are only exported when there
+# are new rows in LOOKUPS. Between syncs everything stays warm - kakasi and the transliteration cache,
+# the HTTP session and its connections, the preprocessing workers and the words already added -
+# so a sync only costs the requests for its new words.
+# Always returns True - stopping is how it's meant to finish
+def watch_vocab_db(sync: VocabSync, settings: AccountSettings, state: ImportState, preprocess_pool=None, conversion_lock=None,
+                   reconcile: bool = False) -> bool:
+    prior_results = load_prior_results(settings, False, reconcile, state)
+    if prior_results is None:
+        return False
+    existing_courses, provisioned = course_progress(prior_results)
+    interval = settings.watch_interval
+    # Only made once there's something to upload, then kept for every sync after
+    uploader = None
+    # Whether we stopped part way through a sync, which leaves its uploads unfinished
+    interrupted = False
+    last_fingerprint = last_stamp = None
+    print('Watching ' + sync.db_file + ' for new lookups every ' + str(interval) + 's. Ctrl+c to stop')
+    try:
+        while not state.stopping.is_set():
+            fingerprint = db_fingerprint(sync.db_file)
+            if fingerprint != last_fingerprint:
+                try:
+                    stamp = sync.lookups_stamp()
+                    kindle_data = convert_new_lookups(sync, state, conversion_lock) if stamp != last_stamp else ''
+                except sqlite3.Error as e:
+                    # Most likely caught the kindle (or a copy) part way through writing it. Try again next time round
+                    print('Couldn\'t read ' + sync.db_file + ' (' + str(e) + '), trying again in ' + str(interval) + 's')
+                    fingerprint = stamp = None
+                    kindle_data = ''
+                last_fingerprint, last_stamp = fingerprint, stamp
+                if kindle_data:
+                    if uploader is None:
+                        drop_cached_remote_index(state)
+                        uploader = Uploader(settings, state, preprocess_pool)
+                    if sync_books(read_kindle_books(kindle_data), existing_courses, provisioned, uploader, state):
+                        # Everything's imported (or recorded as a failure), so we don't need to look at these lookups again
+                        sync.commit()
+                    else:
+                        # Not straight away - whatever went wrong would most likely go wrong again
+                        print('Some words were neither added nor recorded as failures, so these lookups will be imported again '
+                              'along with the next new ones')
+            state.stopping.wait(interval)
+    except KeyboardInterrupt:
+        # As with a normal import, everything that finished uploading is already in the journal, and the lookups
+        # from the sync we were part way through get looked at again next time
+        print('Interrupted - stopping the watch')
+        interrupted = True
+    if uploader is None:
+        create_results_json(state)
+    else:
+        finish_import(uploader, not interrupted, state)
+    return True
+
+# One sync of watch mode: plans and uploads the books with an uploader that stays open between syncs.
+# existing_courses and provisioned are kept up to date for the next sync, and what got added joins previously_added.
+# Returns whether every word was either added or recorded as a failure (see all_recorded)
+def sync_books(books, existing_courses: dict, provisioned: dict, uploader: Uploader, state: ImportState) -> bool:
+    # The kindle data for a sync is small, so it's simplest to read it once for both the plan and the upload
+    books = [{'title': book['title'], 'words': list(book['words'])} for book in books]
+    # Each sync is a round of its own, so words only count as duplicates of others in the same sync
+    state.dedup_index = state.dedup_index.fresh()
+    with state.metrics.stage('plan'):
+        plan = plan_import(books, existing_courses, state.dedup_index.fresh(), provisioned)
+    plan.print_summary()
+    if plan.words() == 0:
+        print('Nothing new to upload.')
+        return True
+    failed_before = len(state.failed_to_add)
+    unrecorded_before = state.metrics.counter('words unrecorded')
+    course_ids = upload_plan(plan, books, existing_courses, provisioned, [], uploader, state)
+    # Courses made ahead of time that no book has got to yet are still there for the next sync
+    provisioned.clear()
+    provisioned.update({(title, number): course_id for (title, number), course_id in course_ids.items()
+                        if number > existing_courses.get(title, ('', -1, 0))[1]})
+    # The words we just added are the next sync's previously added words. Words that failed are left out, so they're
+    # tried again if they're looked up again (and --retry-failures still has them)
+    for word in state.added:
+        state.previously_added[word] = None
+        state.dedup_index.remember_added(word)
+    print('Synced: {added} words added, {failed} failed'.format(added=len(state.added), failed=len(state.failed_to_add) - failed_before))
+    state.added.clear()
+    # So the transliterations are on disk even if we're killed rather than stopped
+    trans_cache.close()
+    return state.metrics.counter('words unrecorded') == unrecorded_before
+
+# Runs the import for every account in a batch file at once, each with its own results, state
+# directory and request budget. Kakasi, the transliteration cache and the preprocessing pool are shared.
+# Returns False if any account didn't finish
+def run_batch(batch: dict, args) -> bool:
+    accounts = batch['accounts']
+    # Every account's files go in a directory named after it, unless it says otherwise
+    state_dirs = [account.get('state_dir', account['name']) for account in accounts]
+    if len(set(state_dirs)) != len(state_dirs):
+        print('Every account needs its own name (or state_dir), or they\'d overwrite each other\'s results')
+        return False
+    # The kindle converter always writes ./kindle_data.json before it's moved into the account's directory,
+    # so it would overwrite (and then move away) another account's kindle data kept there
+    if any(account.get('vocab_db') for account in accounts):
+        for account in accounts:
+            if not account.get('vocab_db') and os.path.abspath(account.get('kindle_data') or '') == os.path.abspath('kindle_data.json'):
+                print(account['name'] + '\'s kindle_data can\'t be ./kindle_data.json when another account uses a vocab_db - '
+                      'converting its lookups would overwrite it. Move it somewhere else')
+                return False
+    states = [ImportState(state_dir, account['name']) for account, state_dir in zip(accounts, state_dirs)]
+    preprocess_pool = make_pool(batch.get('preprocess_workers', None))
+    conversion_lock = threading.Lock()
+    outcomes = {}
+    try:
+        with ThreadPoolExecutor(max_workers=len(accounts), thread_name_prefix='iknow-account') as runner:
+            futures = {runner.submit(run_account, account, args, state, preprocess_pool, conversion_lock): state
+                       for account, state in zip(accounts, states)}
+            try:
+                wait(futures)
+            except KeyboardInterrupt:
+                # Only this thread sees ctrl+c - pass it on to every account, and let them wrap up
+                print('Interrupted - stopping every account')
+                for state in states:
+                    state.stopping.set()
+                wait(futures)
+            for future, state in futures.items():
+                try:
+                    outcomes[state.name] = 'finished' if future.result() else 'not finished'
+                except Exception as e:
+                    outcomes[state.name] = 'failed: ' + str(e)
+    finally:
+        if preprocess_pool is not None:
+            preprocess_pool.shutdown()
+    for state in states:
+        counters = state.metrics.report()['counters']
+        print('{name}: {outcome}, {added} words added, {failed} words failed'.format(
+            name=state.name, outcome=outcomes.get(state.name, 'not run'), added=counters.get('items added', 0),
+            failed=counters.get('items failed', 0)))
+    return all(outcome == 'finished' for outcome in outcomes.values())
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Import Kindle lookups into iKnow')
+    parser.add_argument('--dry-run', action='store_true', help='print what would be uploaded, and roughly how many requests it takes, without uploading anything')
+    parser.add_argument('--retry-failures', action='store_true', help='only retry the words and sample sentences prior_results.json says we failed to add')
+    parser.add_argument('--reconcile', action='store_true', help='check what\'s already in your iKnow courses first, and never upload those words again - for when prior_results.json is lost or out of date')
+    parser.add_argument('--watch', action='store_true', help='keep running, importing new lookups from vocab_db as soon as they show up, until ctrl+c')
+    parser.add_argument('--accounts', help='import for every account in this batch file at once, instead of the one in generation_info.json')
+    args = parser.parse_args()
     print('Running')
     '''
     arg: cookie string
@@ -418,28 +976,12 @@ if __name__ == "__main__":
     arg: csrf token
         firefox: same deal, but take the csrf token
     '''
-    cookies = ''
-    csrf_token = ''
-    kindle_data = ''
-    db_file = ''
-    with open('generation_info.json', 'r') as g:
-        info = json.load(g)
-        cookies = info['cookies']
-        csrf_token = info['csrf_token']
-        kindle_data = info['kindle_data']
-        db_file = info['vocab_db']
-    
-    if not kindle_data and not db_file:
-        print('Supply a db path or kindle data path please.')
-        print('Note if you supply both we will not use the kindle_data and instead generate from the DB')
-        exit(1)
-    if not cookies or not csrf_token:
-        print('Need cookies and csrf token to upload data.')
-        exit(1)
-    if db_file:
-        print('Creating kindle data from vocab.db file...')
-        create_json_from_db(db_file)
-        kindle_data = 'kindle_data.json'
-
-    print('Starting import process...')
-    convert_json_to_items(cookies, csrf_token, kindle_data)
\ No newline at end of file
+    if args.accounts:
+        with open(args.accounts, 'r', encoding='utf-8') as a:
+            batch = json.load(a)
+        finished = run_batch(batch, args)
+    else:
+        with open('generation_info.json', 'r') as g:
+            info = json.load(g)
+        finished = run_account(info, args, ImportState())
+    exit(0 if finished else 1)
@@ -0,0 +1,184 @@
+import json # for writing events and the snapshot
+import os # for swapping in a new snapshot atomically
+import threading # for sharing the journal between upload workers
+from records import CourseTable, FailedItem, FailedSample
+
+# Write-ahead journal of everything an import does.
+# Each created course, added item/sentence and failure is appended as one JSON line the moment it
+# happens, so a crash or ctrl+c never loses track of what's already in iKnow. Compacting folds the
+# journal into the prior_results.json snapshot and starts a fresh journal.
+#
+# The snapshot keeps the same layout prior_results.json always had:
+#   {"courses": [{"title", "cur_course_id", "number", "items"}], "added": [words],
+#    "not-added": [{"course", "course_id", "word", "reading", "definition", "part_of_speech", "sample"}],
+#    "no-sample": [{"course", "course_id", "word", "word_id", "sentence", "definition"}],
+#    "provisioned": [{"title", "number", "course_id"}]}
+# where "provisioned" are courses created ahead of time that we haven't started adding to yet.
+# Failures keep everything needed to retry them. Ones from older versions may only have the word.
+class Journal:
+    def __init__(self, snapshot_path: str = 'prior_results.json', journal_path: str = 'prior_results.journal'):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.file = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # Appends one event. Only ever costs a single line write, no matter how big the history gets
+    def record(self, event: dict) -> None:
+        line = json.dumps(event, ensure_ascii=False) + '\n'
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.journal_path, 'a', encoding='utf-8')
+            self.file.write(line)
+            # Flush every event so it's with the OS even if we get killed right after
+            self.file.flush()
+
+    def course(self, title: str, course_id: str, number: int, items: int) -> None:
+        self.record({'event': 'course', 'title': title, 'cur_course_id': course_id, 'number': number, 'items': items})
+
+    def provisioned(self, title: str, number: int, course_id: str) -> None:
+        self.record({'event': 'provisioned', 'title': title, 'number': number, 'course_id': course_id})
+
+    def item(self, word: str, word_id: str, course_id: str) -> None:
+        self.record({'event': 'item', 'word': word, 'word_id': word_id, 'course_id': course_id})
+
+    def sentence(self, word: str, word_id: str) -> None:
+        self.record({'event': 'sentence', 'word': word, 'word_id': word_id})
+
+    def failed_item(self, failure: FailedItem) -> None:
+        self.record({'event': 'not-added', **failure.to_dict()})
+
+    def failed_sample(self, failure: FailedSample) -> None:
+        self.record({'event': 'no-sample', **failure.to_dict()})
+
+    # Reads the snapshot and replays the journal on top of it, returning the combined results
+    def load(self) -> 'Results':
+        results = Results()
+        courses, added, not_added, no_sample, provisioned = (results.courses, results.added, results.not_added,
+                                                             results.no_sample, results.provisioned)
+        course_titles = {} # course id -> title, for counting items as they're replayed
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as pr:
+                snapshot = json.load(pr)
+        except FileNotFoundError:
+            snapshot = {}
+        for course in snapshot.get('courses', []):
+            courses[course['title']] = course
+            course_titles[course['cur_course_id']] = course['title']
+        for word in snapshot.get('added', []):
+            added[word] = None
+        for failure in snapshot.get('not-added', []):
+            not_added[failure['word']] = FailedItem.from_dict(failure, results.course_refs)
+        for failure in snapshot.get('no-sample', []):
+            no_sample[failure['word']] = FailedSample.from_dict(failure, results.course_refs)
+        for course in snapshot.get('provisioned', []):
+            provisioned[(course['title'], course['number'])] = course
+        # Done with the parsed snapshot - only the records built from it are kept
+        del snapshot
+
+        for event in self.events():
+            kind = event.pop('event')
+            if kind == 'course':
+                courses[event['title']] = event
+                course_titles[event['cur_course_id']] = event['title']
+                # Once we've moved onto a course it's no longer waiting to be used
+                for key in [key for key in provisioned if key[0] == event['title'] and key[1] <= event['number']]:
+                    del provisioned[key]
+            elif kind == 'provisioned':
+                provisioned[(event['title'], event['number'])] = event
+            elif kind == 'item':
+                added[event['word']] = None
+                not_added.pop(event['word'], None)
+                title = course_titles.get(event['course_id'])
+                if title is not None and courses[title]['cur_course_id'] == event['course_id']:
+                    courses[title]['items'] += 1
+            elif kind == 'sentence':
+                no_sample.pop(event['word'], None)
+            elif kind == 'not-added':
+                if event['word'] not in added:
+                    not_added[event['word']] = FailedItem.from_dict(event, results.course_refs)
+            elif kind == 'no-sample':
+                no_sample[event['word']] = FailedSample.from_dict(event, results.course_refs)
+        return results
+
+    # Yields every event in the journal, oldest first
+    def events(self):
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as j:
+                for line in j:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # Only the last line can be cut off, if we died mid-write. Nothing after it to lose
+                        print('Skipping a partly written line at the end of ' + self.journal_path)
+        except FileNotFoundError:
+            return
+
+    # Folds the journal into the snapshot and starts a fresh journal. Returns the compacted results
+    def compact(self) -> 'Results':
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            results = self.load()
+            # Write the new snapshot to the side first, so a crash here leaves the old snapshot and journal intact
+            temp_path = self.snapshot_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as j:
+                write_snapshot(results, j)
+                j.flush()
+                os.fsync(j.fileno())
+            os.replace(temp_path, self.snapshot_path)
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+        return results
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+
+
+# Everything the snapshot and journal add up to. Added words are the keys of a dict - a set that
+# remembers the order they were added in - and failures are records keyed on their word
+class Results:
+    def __init__(self):
+        self.courses = {} # title -> {"title", "cur_course_id", "number", "items"}
+        self.added = {} # word -> None
+        self.not_added = {} # word -> FailedItem
+        self.no_sample = {} # word -> FailedSample
+        self.provisioned = {} # (title, number) -> {"title", "number", "course_id"}
+        # Every failure in the same course shares one CourseRef from here
+        self.course_refs = CourseTable()
+
+    # Each section of the snapshot, in the order it's written out. Failures are only turned
+    # back into dicts one at a time, as they're written
+    def sections(self) -> list:
+        return [
+            ('courses', self.courses.values()),
+            ('added', self.added),
+            ('not-added', (failure.to_dict() for failure in self.not_added.values())),
+            ('no-sample', (failure.to_dict() for failure in self.no_sample.values())),
+            ('provisioned', self.provisioned.values()),
+        ]
+
+# Writes results out in the snapshot layout, a value at a time rather than as one big string.
+# Comes out exactly as json.dumps(..., indent=4) would
+def write_snapshot(results: Results, f) -> None:
+    encoder = json.JSONEncoder(indent=4, ensure_ascii=False)
+    f.write('{')
+    for i, (key, values) in enumerate(results.sections()):
+        f.write((',' if i else '') + '\n    ' + encoder.encode(key) + ': [')
+        empty = True
+        for value in values:
+            f.write(('\n' if empty else ',\n') + '        ' + encoder.encode(value).replace('\n', '\n        '))
+            empty = False
+        f.write(']' if empty else '\n    ]')
+    f.write('\n}')
@@ -0,0 +1,173 @@
+import json # for decoding the individual values we pull out of the stream
+
+# How much of the file we read at a time
+READ_SIZE = 64 * 1024
+WHITESPACE = ' \t\r\n'
+# Characters that can carry on a number - if one follows what we decoded, the number may not be finished yet
+NUMBER_CHARS = '0123456789.eE+-'
+
+# Pulls JSON tokens and values out of a file a chunk at a time, so we never hold more
+# than a chunk (plus whatever value we're in the middle of) in memory
+class JSONStreamReader:
+    def __init__(self, f):
+        self.file = f
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    # Read more of the file into the buffer. Returns False once there's nothing left
+    def fill(self, size: int = READ_SIZE) -> bool:
+        if self.eof:
+            return False
+        chunk = self.file.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        # Drop everything we've already parsed before growing the buffer
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    # Returns the next non-whitespace character without consuming it, or '' at the end of the file
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char: str) -> None:
+        found = self.peek()
+        if found != char:
+            raise ValueError('Expected {char!r} in kindle data, found {found!r}'.format(char=char, found=found))
+        self.pos += 1
+
+    # Consumes a ',' if there is one. Returns False if we hit the closing bracket instead
+    def next_in_container(self, close: str) -> bool:
+        char = self.peek()
+        if char == ',':
+            self.pos += 1
+            return True
+        if char == close:
+            return False
+        raise ValueError('Expected , or {close!r} in kindle data, found {char!r}'.format(close=close, char=char))
+
+    # Decodes the next complete value (string, number, object, array...)
+    def read_value(self):
+        self.peek()
+        read_size = READ_SIZE
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer might carry on in the next chunk - and a chunk that ends part way
+                # through one ("1234." or "2e") decodes as just the part before the '.' or 'e'
+                number = isinstance(value, (int, float)) and not isinstance(value, bool)
+                if self.eof or (end < len(self.buf) and not (number and self.buf[end] in NUMBER_CHARS)):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Value is split across chunks - read more, in bigger steps if it's a big one
+            self.fill(read_size)
+            read_size *= 2
+
+    # Yields each element of the array we're at the start of
+    def iter_array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            if not self.next_in_container(']'):
+                self.pos += 1
+                return
+
+    # Yields the key of each member of the object we're at the start of. The caller must consume
+    # the member's value (read_value, iter_array...) before asking for the next key
+    def iter_keys(self):
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(':')
+            yield key
+            if not self.next_in_container('}'):
+                self.pos += 1
+                return
+
+
+# Yields each book in a kindle_data.json file as {"title", "words"}, where "words" is a generator
+# that parses the book's words as they're asked for. Only one book's words are ever being read at a time,
+# and each book must be finished with (or abandoned) before asking for the next.
+def stream_books(f):
+    reader = JSONStreamReader(f)
+    for key in reader.iter_keys():
+        if key != 'books':
+            reader.read_value()
+            continue
+        reader.expect('[')
+        if reader.peek() == ']':
+            reader.pos += 1
+            continue
+        while True:
+            yield from stream_book(reader)
+            if not reader.next_in_container(']'):
+                reader.pos += 1
+                break
+
+# Parses a single book object, yielding it once we've reached its words
+def stream_book(reader: JSONStreamReader):
+    book = {}
+    yielded = False
+    for key in reader.iter_keys():
+        if key == 'words' and 'title' in book and not yielded:
+            words = reader.iter_array()
+            book['words'] = words
+            yielded = True
+            yield book
+            # Skip past whatever words the caller didn't want
+            for _ in words:
+                pass
+        else:
+            # Titles normally come before the words. If they don't, we have to hold onto this book's words
+            book[key] = reader.read_value()
+    if not yielded:
+        book.setdefault('words', [])
+        yield book
+
+
+# A file that hands out its text in two reads, split at the given point
+class SplitFile:
+    def __init__(self, text: str, split: int):
+        self.text = text
+        self.split = split
+        self.pos = 0
+
+    def read(self, size: int) -> str:
+        end = min(self.pos + size, self.split if self.pos < self.split else len(self.text))
+        chunk = self.text[self.pos:end]
+        self.pos = end
+        return chunk
+
+# Checks every place a read could end in some kindle data parses the same as json.load would.
+# Run "python kindle_stream.py" after changing the reader
+def check_split_points() -> None:
+    data = ('{"version": 1.5e-3, "books": [{"title": "a \\"quoted\\" title", "words": [{"word": "猫", "n": 1234.5, "e": -2E+10},'
+            ' 7, true, null, [], {}]}, {"words": [0.25], "title": "words first"}, {"title": "empty", "words": []}]}')
+    expected = json.loads(data)['books']
+    for split in range(len(data) + 1):
+        books = [dict(book, words=list(book['words'])) for book in stream_books(SplitFile(data, split))]
+        if books != expected:
+            raise AssertionError('Reading split at {split} gave {books!r}'.format(split=split, books=books))
+    print('Kindle data parses the same wherever a read ends ({splits} places checked)'.format(splits=len(data) + 1))
+
+
+if __name__ == "__main__":
+    check_split_points()
@@ -0,0 +1,190 @@
+import json # for the metrics file
+import math # for percentile ranks and latency buckets
+import os # for swapping in the metrics file atomically
+import re # for turning urls into endpoint names
+import threading # for sharing the metrics between upload workers
+import time # for timing
+from contextlib import contextmanager
+
+# How often (in seconds) to print progress while importing
+PROGRESS_EVERY = 5.0
+# Request latencies are counted in buckets rather than kept, each LATENCY_GROWTH times as wide as the last,
+# starting at LATENCY_FLOOR seconds. 300 of them reach about 40 minutes, and percentiles come out within 5%
+LATENCY_FLOOR = 0.001
+LATENCY_GROWTH = 1.05
+LATENCY_BUCKETS = 300
+
+# Turns a url into the endpoint it hits, with ids swapped out so every item post counts as the same endpoint.
+# e.g. https://iknow.jp/custom/courses/123/items -> /custom/courses/{id}/items
+def endpoint_name(url: str) -> str:
+    path = re.sub(r'^[a-z]+://[^/]+', '', url).split('?')[0]
+    return re.sub(r'/\d+', '/{id}', path)
+
+
+# Latencies of the requests to one endpoint, as a count per bucket. Takes the same memory whether a run
+# makes a hundred requests or a --watch left running for weeks makes millions
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = [0] * LATENCY_BUCKETS
+        self.requests = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        bucket = 0
+        if seconds > LATENCY_FLOOR:
+            bucket = min(LATENCY_BUCKETS - 1, math.ceil(math.log(seconds / LATENCY_FLOOR, LATENCY_GROWTH)))
+        self.buckets[bucket] += 1
+        self.requests += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    # Nearest-rank percentile, as the top of the bucket it lands in (but never more than the slowest request)
+    def percentile(self, pct: float) -> float:
+        if not self.requests:
+            return 0.0
+        rank = max(1, math.ceil(pct / 100 * self.requests))
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(self.max, LATENCY_FLOOR * LATENCY_GROWTH ** bucket)
+        return self.max
+
+
+# Keeps track of where an import's time goes and how every request went:
+#   stages - total time and number of calls for each step (planning, transliterating, decompressing...)
+#   endpoints - latency of every request to each endpoint, and how many went ok, came back with an error
+#               status or never got an answer at all
+#   counters - anything else worth counting (words uploaded, items/sentences that failed...)
+# It also prints progress, with an ETA, every PROGRESS_EVERY seconds as words finish.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {} # name -> {"count", "seconds"}
+        self.latencies = {} # endpoint -> LatencyHistogram
+        self.responses = {} # endpoint -> {"ok", "error_status", "no_response"}
+        self.counters = {}
+        self.total_words = 0
+        self.done_words = 0
+        self.progress_started = None
+        self.last_progress = 0.0
+
+    # Times everything in the with block as part of the given stage
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_stage(self, name: str, seconds: float) -> None:
+        with self.lock:
+            stage = self.stages.setdefault(name, {'count': 0, 'seconds': 0.0})
+            stage['count'] += 1
+            stage['seconds'] += seconds
+
+    # Records a single request. status is None if it never got a response.
+    # Gets are kept apart from posts to the same endpoint, as "GET <endpoint>"
+    def request(self, url: str, seconds: float, status: int = None, method: str = 'POST') -> None:
+        endpoint = endpoint_name(url) if method == 'POST' else method + ' ' + endpoint_name(url)
+        with self.lock:
+            latencies = self.latencies.get(endpoint)
+            if latencies is None:
+                latencies = self.latencies[endpoint] = LatencyHistogram()
+            latencies.add(seconds)
+            responses = self.responses.setdefault(endpoint, {'ok': 0, 'error_status': 0, 'no_response': 0})
+            if status is None:
+                responses['no_response'] += 1
+            elif status == 200:
+                responses['ok'] += 1
+            else:
+                responses['error_status'] += 1
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def counter(self, name: str) -> int:
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    # Starts the progress/ETA clock for an import of total words
+    def start_progress(self, total: int) -> None:
+        with self.lock:
+            self.total_words = total
+            self.done_words = 0
+            self.progress_started = time.perf_counter()
+            self.last_progress = self.progress_started
+
+    # Marks a word as finished (uploaded or failed), printing progress if it's been a while
+    def word_done(self) -> None:
+        with self.lock:
+            self.done_words += 1
+            now = time.perf_counter()
+            if self.progress_started is None or now - self.last_progress < PROGRESS_EVERY:
+                return
+            self.last_progress = now
+            line = self.progress_line(now)
+        print(line)
+
+    def progress_line(self, now: float) -> str:
+        elapsed = now - self.progress_started
+        rate = self.done_words / elapsed if elapsed > 0 else 0
+        remaining = max(0, self.total_words - self.done_words)
+        eta = format_duration(remaining / rate) if rate > 0 else 'unknown'
+        return 'Progress: {done}/{total} words ({pct:.0%}), {rate:.1f} words/s, about {eta} left'.format(
+            done=self.done_words, total=self.total_words, pct=self.done_words / self.total_words if self.total_words else 1,
+            rate=rate, eta=eta)
+
+    def report(self) -> dict:
+        with self.lock:
+            endpoints = {}
+            for endpoint, latencies in self.latencies.items():
+                endpoints[endpoint] = dict(self.responses[endpoint], **{
+                    'requests': latencies.requests,
+                    'mean': latencies.total / latencies.requests,
+                    'p50': latencies.percentile(50),
+                    'p95': latencies.percentile(95),
+                    'p99': latencies.percentile(99),
+                    'max': latencies.max,
+                })
+            return {
+                'started': self.started,
+                'seconds': time.time() - self.started,
+                'words': {'total': self.total_words, 'done': self.done_words},
+                'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                'endpoints': endpoints,
+                'counters': dict(self.counters),
+            }
+
+    # Prints where the time went, and how each endpoint did
+    def print_summary(self) -> None:
+        report = self.report()
+        print('Time spent per stage:')
+        for name, stage in sorted(report['stages'].items(), key=lambda item: -item[1]['seconds']):
+            print('  {name}: {seconds:.2f}s over {count} calls'.format(name=name, seconds=stage['seconds'], count=stage['count']))
+        print('Request latency per endpoint:')
+        for endpoint, stats in report['endpoints'].items():
+            print('  {endpoint}: {requests} requests ({ok} ok, {bad} error status, {none} no response), p50 {p50:.0f}ms, p95 {p95:.0f}ms, p99 {p99:.0f}ms'.format(
+                endpoint=endpoint, requests=stats['requests'], ok=stats['ok'], bad=stats['error_status'], none=stats['no_response'],
+                p50=stats['p50'] * 1000, p95=stats['p95'] * 1000, p99=stats['p99'] * 1000))
+
+    # Writes the report as JSON. Anything extra (connection/cache/retry stats...) can be passed in too
+    def write(self, path: str, extra: dict = None) -> None:
+        report = self.report()
+        if extra:
+            report.update(extra)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as m:
+            m.write(json.dumps(report, indent=4))
+        os.replace(temp_path, path)
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{h}h{m:02d}m'.format(h=hours, m=minutes)
+    return '{m}m{s:02d}s'.format(m=minutes, s=seconds)
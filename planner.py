@@ -0,0 +1,170 @@
+import unicodedata # for folding full/half width characters together
+from records import Word
+
+# Define some constants
+BAD_DEF = 'NO DEFINITION FOUND'
+BAD_READING = 'NO READING FOUND'
+# iKnow recommends courses have a max of 100 items
+COURSE_SIZE = 100
+
+# What checking a word against the dedup index can tell us
+UPLOAD = 'upload'
+ALREADY_ADDED = 'already added'
+DUPLICATE = 'duplicate'
+BAD_DATA = 'bad data'
+
+# Folds the variants of a word/reading that iKnow would treat as the same thing together:
+# full vs half width (NFKC) and katakana vs hiragana
+def normalize(text: str) -> str:
+    text = unicodedata.normalize('NFKC', text).strip()
+    return ''.join(chr(ord(c) - 0x60) if 'ァ' <= c <= 'ヶ' else c for c in text)
+
+
+# Decides which words actually need uploading.
+# Words are keyed on their normalized (word, reading), so the same word looked up in two books, or
+# written with different widths/kana, is only uploaded once. Checking is deterministic - the first
+# occurrence wins - so two indexes fed the same words in the same order always agree.
+class DedupIndex:
+    def __init__(self, previously_added=()):
+        # prior_results.json only remembers words, not readings
+        self.previous_words = set()
+        self.seen = set()
+        for word in previously_added:
+            self.remember_added(word)
+
+    def remember_added(self, word: str) -> None:
+        normalized = normalize(word)
+        # Most words are already normalized, so keep the string we were given rather than an equal copy of it
+        self.previous_words.add(word if normalized == word else normalized)
+
+    # A new index that knows the same previously added words (shared, not copied), but hasn't seen any words yet
+    def fresh(self) -> 'DedupIndex':
+        index = DedupIndex()
+        index.previous_words = self.previous_words
+        return index
+
+    # Returns UPLOAD if this is the first time we've seen the word, claiming it.
+    # Otherwise returns why it shouldn't be uploaded
+    def check(self, word: Word) -> str:
+        if normalize(word.word) in self.previous_words:
+            return ALREADY_ADDED
+        key = (normalize(word.word), normalize(word.reading))
+        if key in self.seen:
+            return DUPLICATE
+        if word.definition == BAD_DEF or word.reading == BAD_READING:
+            return BAD_DATA
+        self.seen.add(key)
+        return UPLOAD
+
+
+# How one book's words will be spread over its courses
+class BookPlan:
+    def __init__(self, title: str, course_id: str = '', number: int = 0, items: int = 0, provisioned: dict = None):
+        self.title = title
+        # Courses already created for later on in this book, mapping number -> course id
+        self.provisioned = provisioned if provisioned else {}
+        # The course we'll start adding to, if it already exists
+        self.course_id = course_id
+        self.number = number
+        self.items = items
+        self.words = 0 # words to upload
+        self.sentences = 0 # of those, words with a sample sentence
+        self.already_added = 0
+        self.duplicates = 0
+        self.bad = 0
+
+    def add(self, word: Word, outcome: str) -> None:
+        if outcome == UPLOAD:
+            self.words += 1
+            if word.sample:
+                self.sentences += 1
+        elif outcome == ALREADY_ADDED:
+            self.already_added += 1
+        elif outcome == DUPLICATE:
+            self.duplicates += 1
+        else:
+            self.bad += 1
+
+    # Returns a list of {"number", "course_id", "items"} for every course this book's words go into,
+    # where "items" is how many of the words go there and a blank course_id is a course we'll need to create.
+    # Courses are numbered in the same order the upload fills them: top up the current one, then roll over
+    def courses(self) -> list:
+        courses = []
+        remaining = self.words
+        if remaining == 0:
+            return courses
+        number = self.number
+        if self.course_id == '':
+            course_id, space = '', COURSE_SIZE
+        elif self.items >= COURSE_SIZE:
+            # The existing course is full - start the next one
+            number += 1
+            course_id, space = '', COURSE_SIZE
+        else:
+            course_id, space = self.course_id, COURSE_SIZE - self.items
+        while remaining > 0:
+            count = min(space, remaining)
+            if course_id == '':
+                course_id = self.provisioned.get(number, '')
+            courses.append({'number': number, 'course_id': course_id, 'items': count})
+            remaining -= count
+            number += 1
+            course_id, space = '', COURSE_SIZE
+        return courses
+
+    def new_courses(self) -> list:
+        return [course for course in self.courses() if course['course_id'] == '']
+
+    # Courses to create, then an item and (usually) a sentence per word
+    def requests(self) -> int:
+        return len(self.new_courses()) + self.words + self.sentences
+
+
+class ImportPlan:
+    def __init__(self):
+        self.books = {} # title -> BookPlan
+
+    def words(self) -> int:
+        return sum(book.words for book in self.books.values())
+
+    def requests(self) -> int:
+        return sum(book.requests() for book in self.books.values())
+
+    # retry_samples is how many sample sentences are being re-attached alongside the plan, a request each
+    def print_summary(self, retry_samples: int = 0) -> None:
+        print('Import plan:')
+        for book in self.books.values():
+            new_courses = [book.title + ' ' + str(course['number']) for course in book.new_courses()]
+            print('  {title}: {words} words to add ({already} already added, {dupes} duplicates, {bad} with a bad reading or definition)'.format(
+                title=book.title, words=book.words, already=book.already_added, dupes=book.duplicates, bad=book.bad))
+            if new_courses:
+                print('    new courses: ' + ', '.join(new_courses))
+        if retry_samples:
+            print('{samples} sample sentences to re-attach'.format(samples=retry_samples))
+        print('{words} words to add, {courses} courses to create, about {requests} requests'.format(
+            words=self.words(), courses=len(self.new_courses()), requests=self.requests() + retry_samples))
+
+    # Returns (title, #) for every course that has to be created before uploading
+    def new_courses(self) -> list:
+        return [(book.title, course['number']) for book in self.books.values() for course in book.new_courses()]
+
+
+# Works out everything an import will do before making any requests.
+# existing_courses maps a title to (cur course id, cur #, cur items), as in prior_results.json.
+# index is a DedupIndex of the words added before that hasn't seen any of these books yet (see DedupIndex.fresh).
+# provisioned maps (title, #) to the id of a course that's been created but not added to yet
+def plan_import(books, existing_courses: dict, index: DedupIndex, provisioned: dict = None) -> ImportPlan:
+    provisioned = provisioned if provisioned else {}
+    plan = ImportPlan()
+    for book in books:
+        title = book['title']
+        book_plan = plan.books.get(title)
+        if book_plan is None:
+            course_id, number, items = existing_courses.get(title, ('', 0, 0))
+            book_provisioned = {course_number: provisioned_id for (course_title, course_number), provisioned_id in provisioned.items()
+                                if course_title == title}
+            book_plan = BookPlan(title, course_id, number, items, book_provisioned)
+            plan.books[title] = book_plan
+        for word in book['words']:
+            book_plan.add(word, index.check(word))
+    return plan
@@ -0,0 +1,179 @@
+import contextlib # for not timing anything when there are no metrics
+import multiprocessing # for picking how worker processes are started
+import os # for counting cores
+import signal # for leaving ctrl+c to the main process
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# How many sentences/words we hand a worker process at once. Big enough that pickling
+# doesn't eat the gains, small enough that uploads can start before the whole book is done
+CHUNK_SIZE = 64
+# How many words we prepare in one go. Bounds how much of a book is in memory at once
+BATCH_SIZE = 1024
+
+# Runs in a worker process. Transliterates a chunk of sentences, returning (sentence, hiragana)
+# pairs with an empty string for anything kakasi couldn't handle
+def transliterate_chunk(sentences: list) -> list:
+    # Imported here so worker processes load kakasi once, on their first chunk of work
+    from import_to_iknow import convert_sentence
+    results = []
+    for sentence in sentences:
+        try:
+            results.append((sentence, convert_sentence(sentence)))
+        except Exception:
+            results.append((sentence, ''))
+    return results
+
+# Runs in a worker process. Url-encodes the item and sentence payloads for a chunk of (word, transliteration) pairs.
+# Words without a transliteration get an empty sentence payload
+def build_payloads_chunk(words_and_trans: list) -> list:
+    from import_to_iknow import build_item_payload, build_sentence_payload
+    payloads = []
+    for word, trans in words_and_trans:
+        sentence_payload = build_sentence_payload(word, trans) if trans else ''
+        payloads.append((build_item_payload(word), sentence_payload))
+    return payloads
+
+def chunked(items: list, size: int = CHUNK_SIZE) -> list:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+# Groups any iterable into lists of up to size items, without reading ahead any further than that.
+# The first list can be made smaller, to get started on it sooner
+def batched(items, size: int = BATCH_SIZE, first_size: int = None):
+    batch = []
+    limit = first_size or size
+    for item in items:
+        batch.append(item)
+        if len(batch) >= limit:
+            yield batch
+            batch = []
+            limit = size
+    if batch:
+        yield batch
+
+
+# Runs in each worker process as it starts. Ctrl+c goes to every process in the terminal, but it's the
+# main process that decides what to stop - otherwise idle workers die printing tracebacks (and --watch stops with ctrl+c)
+def ignore_interrupts() -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# Makes a pool of worker processes to preprocess on, or None for workers = 0
+def make_pool(workers: int = None):
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    if workers <= 0:
+        return None
+    # Spawn rather than fork - the upload threads may be holding locks when we fork otherwise
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=ignore_interrupts)
+
+
+# The CPU-heavy half of an import: transliterating sample sentences and encoding payloads.
+# Runs on a pool of processes so a big book uses every core, while the upload engine's
+# threads keep the network busy with whatever has already been prepared.
+# Imports running side by side can share one pool (made with make_pool) - it's left running on close.
+class Preprocessor:
+    def __init__(self, cache, workers: int = None, metrics=None, pool=None):
+        self.cache = cache
+        # Metrics to time transliterating and encoding in, if any
+        self.metrics = metrics
+        self.shared_pool = pool is not None
+        self.pool = pool if pool is not None else make_pool(workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(cancel=exc_type is not None)
+
+    # Workers set to 0 runs everything in this process instead
+    def map(self, fn, chunks: list):
+        if self.pool is None:
+            return map(fn, chunks)
+        return self.pool.map(fn, chunks)
+
+    # Works out the transliteration for every distinct sentence in words, using the cache where we can.
+    # Returns a dict of sentence -> hiragana, with empty strings for failures
+    def transliterate(self, words: list) -> dict:
+        translits = {}
+        missing = []
+        # Sentences another import sharing the cache is converting right now, mapped to an event set when it's done
+        others = {}
+        for sentence in dict.fromkeys(word.sample for word in words):
+            if not sentence:
+                # Nothing to transliterate - and the cache never keeps '', so claiming it would always be a miss
+                translits[sentence] = ''
+                continue
+            trans, converting = self.cache.claim(sentence)
+            if trans is not None:
+                translits[sentence] = trans
+            elif converting is not None:
+                others[sentence] = converting
+            else:
+                missing.append(sentence)
+        try:
+            for results in self.map(transliterate_chunk, chunked(missing)):
+                for sentence, trans in results:
+                    translits[sentence] = trans
+                    self.cache.release(sentence, trans)
+        finally:
+            # Don't leave anyone waiting on sentences we never got to
+            for sentence in missing:
+                if sentence not in translits:
+                    self.cache.release(sentence, '')
+        for sentence, converting in others.items():
+            converting.wait()
+            trans, converting = self.cache.claim(sentence)
+            if trans is None and converting is None:
+                # Still not in the cache - kakasi couldn't handle it for them either
+                self.cache.release(sentence, '')
+            translits[sentence] = trans or ''
+        return translits
+
+    # Transliterates and encodes a whole batch of words, returning a prepared dict of
+    # {"word", "trans", "item_payload", "sentence_payload"} for each, in order
+    def prepare_batch(self, batch: list) -> list:
+        with self.stage('transliterate'):
+            translits = self.transliterate(batch)
+        pairs = [(word, translits[word.sample]) for word in batch]
+        with self.stage('encode payloads'):
+            batch_payloads = list(self.map(build_payloads_chunk, chunked(pairs)))
+        prepared = []
+        for chunk, payloads in zip(chunked(pairs), batch_payloads):
+            for (word, trans), (item_payload, sentence_payload) in zip(chunk, payloads):
+                prepared.append({
+                    'word': word,
+                    'trans': trans,
+                    'item_payload': item_payload,
+                    'sentence_payload': sentence_payload,
+                })
+        return prepared
+
+    # Yields a prepared dict for each word, in order. Words are read from the iterable a batch at a time,
+    # and the next batch is prepared on a helper thread while this one is uploaded, so the uploads
+    # don't sit idle at the start of every batch. The first batch is a single chunk so uploads start
+    # straight away. At most two batches are in memory at once.
+    def prepare(self, words):
+        batches = batched(words, first_size=CHUNK_SIZE)
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='preprocess') as ahead:
+            batch = next(batches, None)
+            upcoming = ahead.submit(self.prepare_batch, batch) if batch else None
+            while upcoming is not None:
+                prepared = upcoming.result()
+                # Words are only ever read from the iterable here, so it doesn't need to be thread safe
+                batch = next(batches, None)
+                upcoming = ahead.submit(self.prepare_batch, batch) if batch else None
+                for item in prepared:
+                    word = item['word']
+                    if item['trans'] == '' and word.sample:
+                        # Words without a sample sentence have nothing to transliterate, so that's not a failure
+                        print('Failed to transliterate sample sentence for word:' + word.word)
+                        print(word.sample)
+                    yield item
+
+    def stage(self, name: str):
+        if self.metrics is None:
+            return contextlib.nullcontext()
+        return self.metrics.stage(name)
+
+    def close(self, cancel: bool = False) -> None:
+        if self.pool is not None and not self.shared_pool:
+            self.pool.shutdown(wait=True, cancel_futures=cancel)
+        self.pool = None
@@ -0,0 +1,112 @@
+import sys # for interning the handful of distinct part of speech strings
+
+# Compact records for the words, courses and failures an import keeps hold of.
+# A big history means hundreds of thousands of these, so they use __slots__ rather than a dict each,
+# and failures point at a shared CourseRef rather than repeating their course's title and id.
+
+
+# A word from the kindle data: {"word", "reading", "definition", "part_of_speech", "sample"}.
+# Failures from older versions may only remember the word - the rest is None until we look it up
+class Word:
+    __slots__ = ('word', 'reading', 'definition', 'part_of_speech', 'sample')
+
+    def __init__(self, word: str, reading: str = None, definition: str = None, part_of_speech: str = None, sample: str = None):
+        self.word = word
+        self.reading = reading
+        self.definition = definition
+        # Almost every word is one of a few parts of speech, so they can all share one string
+        self.part_of_speech = sys.intern(part_of_speech) if part_of_speech else part_of_speech
+        self.sample = sample
+
+    @classmethod
+    def from_dict(cls, word: dict) -> 'Word':
+        return cls(word['word'], word['reading'], word['definition'], word['part_of_speech'], word['sample'])
+
+    # Whether we have everything needed to upload it
+    def complete(self) -> bool:
+        return self.definition is not None
+
+    # Pickles as a plain tuple of its fields, which keeps what goes to the preprocessing workers small
+    def __reduce__(self):
+        return (Word, (self.word, self.reading, self.definition, self.part_of_speech, self.sample))
+
+    def __repr__(self):
+        return 'Word({word!r}, {reading!r})'.format(word=self.word, reading=self.reading)
+
+
+# One course, as "<title> <number>" and its iKnow id. Made through a CourseTable so every
+# word and failure in the same course shares a single one
+class CourseRef:
+    __slots__ = ('name', 'course_id')
+
+    def __init__(self, name: str, course_id: str):
+        self.name = name
+        self.course_id = course_id
+
+    # The book the course belongs to. Courses are named "<title> <number>"
+    @property
+    def title(self) -> str:
+        return self.name.rsplit(' ', 1)[0]
+
+    def __repr__(self):
+        return 'CourseRef({name!r}, {course_id!r})'.format(name=self.name, course_id=self.course_id)
+
+
+# Hands out one CourseRef per (name, id). Thread safe enough for the upload workers - at worst two
+# of them race and make the same course twice, which only costs a few bytes
+class CourseTable:
+    def __init__(self):
+        self.refs = {} # (name, course id) -> CourseRef
+
+    def get(self, name: str, course_id: str) -> CourseRef:
+        ref = self.refs.get((name, course_id))
+        if ref is None:
+            ref = self.refs.setdefault((name, course_id), CourseRef(name, course_id))
+        return ref
+
+
+# A word we couldn't add as an item. Written out as
+# {"course", "course_id", "word", "reading", "definition", "part_of_speech", "sample"}
+class FailedItem:
+    __slots__ = ('course', 'word')
+
+    def __init__(self, course: CourseRef, word: Word):
+        self.course = course
+        self.word = word
+
+    @classmethod
+    def from_dict(cls, failure: dict, courses: CourseTable) -> 'FailedItem':
+        word = Word(failure['word'], failure.get('reading'), failure.get('definition'), failure.get('part_of_speech'), failure.get('sample'))
+        return cls(courses.get(failure['course'], failure['course_id']), word)
+
+    def to_dict(self) -> dict:
+        failure = {'course': self.course.name, 'course_id': self.course.course_id, 'word': self.word.word}
+        # Older failures only have the word, and stay that way until they're retried
+        if self.word.complete():
+            failure.update(reading=self.word.reading, definition=self.word.definition,
+                           part_of_speech=self.word.part_of_speech, sample=self.word.sample)
+        return failure
+
+
+# An item that's in iKnow without its sample sentence. Written out as
+# {"course", "course_id", "word", "word_id", "sentence", "definition"}
+class FailedSample:
+    __slots__ = ('course', 'word', 'word_id')
+
+    def __init__(self, course: CourseRef, word: Word, word_id: str):
+        self.course = course
+        self.word = word
+        self.word_id = word_id
+
+    @classmethod
+    def from_dict(cls, failure: dict, courses: CourseTable) -> 'FailedSample':
+        # Only the sentence and definition go into the sentence payload, so that's all that's kept
+        word = Word(failure['word'], '', failure.get('definition'), '', failure['sentence'])
+        return cls(courses.get(failure['course'], failure['course_id']), word, failure['word_id'])
+
+    def to_dict(self) -> dict:
+        failure = {'course': self.course.name, 'course_id': self.course.course_id, 'word': self.word.word,
+                   'word_id': self.word_id, 'sentence': self.word.sample}
+        if self.word.definition is not None:
+            failure['definition'] = self.word.definition
+        return failure
@@ -0,0 +1,110 @@
+import json # for the cached index
+import os # for swapping in the cached index atomically
+import re # for pulling the book title and number out of course names
+import time # for expiring the cached index
+
+# Courses we make are named "<book title> <number>"
+COURSE_NAME = re.compile(r'^(.*) (\d+)$')
+# How long (in seconds) a cached index is used for before it's fetched again
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+
+# What's actually in the account's iKnow courses: every course, and the words in each with their item ids.
+# Fetching it takes a request per page of courses and per page of every course's items, so it's cached
+# on disk and only fetched again once it's older than max_age (or was fetched from a different site).
+class RemoteIndex:
+    def __init__(self, base_url: str, fetched: float = None):
+        self.base_url = base_url
+        self.fetched = time.time() if fetched is None else fetched
+        self.courses = {} # course id -> {"name", "items": {word: item id}}
+
+    def add_course(self, course_id: str, name: str, items: dict) -> None:
+        self.courses[str(course_id)] = {'name': name, 'items': items}
+
+    # Records an item we've just added, to keep the index up to date while we import.
+    # Called from the upload workers - each step is a single dict operation, so they can't trip each other up
+    def add_item(self, course_id: str, name: str, word: str, item_id: str) -> None:
+        self.courses.setdefault(str(course_id), {'name': name, 'items': {}})['items'][word] = str(item_id)
+
+    def items(self) -> int:
+        return sum(len(course['items']) for course in self.courses.values())
+
+    # Yields (title, number, course id, items) for every course named like the ones we make
+    def book_courses(self):
+        for course_id, course in self.courses.items():
+            match = COURSE_NAME.match(course['name'])
+            if match:
+                yield match[1], int(match[2]), course_id, course['items']
+
+    def save(self, path: str) -> None:
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'base_url': self.base_url, 'fetched': self.fetched, 'courses': self.courses}, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+    # Returns the index cached at path, or None if there isn't one we can still trust
+    @classmethod
+    def load(cls, path: str, base_url: str, max_age: float = DEFAULT_MAX_AGE) -> 'RemoteIndex':
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get('base_url') != base_url or 'courses' not in cached or time.time() - cached.get('fetched', 0) > max_age:
+            return None
+        index = cls(base_url, cached['fetched'])
+        index.courses = cached['courses']
+        return index
+
+
+# Brings results (see Journal.load) up to date with what's actually in iKnow, so nothing that's already
+# there gets uploaded again and new words carry on in the right courses:
+#   - every word in one of our courses counts as added, and stops being a failure
+#   - each book carries on from its highest numbered course, if that's further along than we thought
+#   - empty courses after that are ones we made ahead of time, and get used before making any more
+# It only ever adds to what we know, so an index fetched before our last import can't undo any of it.
+# The changes are recorded in journal too, if given. Returns how many words and courses were new to us
+def reconcile_results(index: RemoteIndex, results, journal=None) -> dict:
+    found = {'words': 0, 'courses': 0}
+    # The course each book is currently adding to, by id. Like replaying the journal, items found
+    # in a book's current course count towards it
+    current = {course['cur_course_id']: course for course in results.courses.values()}
+    latest = {} # title -> (number, course id, items) of its highest numbered course with anything in it
+    empty = [] # (title, number, course id) of courses with nothing in them yet
+    for title, number, course_id, items in index.book_courses():
+        for word, item_id in items.items():
+            if word in results.added:
+                continue
+            results.added[word] = None
+            results.not_added.pop(word, None)
+            if course_id in current:
+                current[course_id]['items'] += 1
+            if journal is not None:
+                journal.item(word, item_id, course_id)
+            found['words'] += 1
+        if not items:
+            empty.append((title, number, course_id))
+        elif title not in latest or number > latest[title][0]:
+            latest[title] = (number, course_id, len(items))
+    # Courses go in after their items - a course event sets the count its items were just added to
+    for title, (number, course_id, items) in latest.items():
+        course = results.courses.get(title)
+        if course is not None and number <= course['number'] and (course_id != course['cur_course_id'] or items <= course['items']):
+            continue
+        results.courses[title] = {'title': title, 'cur_course_id': course_id, 'number': number, 'items': items}
+        # Any course we made ahead of time up to this one has been used
+        for key in [key for key in results.provisioned if key[0] == title and key[1] <= number]:
+            del results.provisioned[key]
+        if journal is not None:
+            journal.course(title, course_id, number, items)
+        found['courses'] += 1
+    # Empty courses past where a book's got to were made ahead of time, so use them rather than making more
+    for title, number, course_id in empty:
+        course = results.courses.get(title)
+        if (course is not None and number <= course['number']) or (title, number) in results.provisioned:
+            continue
+        results.provisioned[(title, number)] = {'title': title, 'number': number, 'course_id': course_id}
+        if journal is not None:
+            journal.provisioned(title, number, course_id)
+        found['courses'] += 1
+    return found
@@ -0,0 +1,125 @@
+import random # for jittering backoff
+import threading # for sharing the error window between workers
+import time # for sleeping between attempts
+from collections import deque # for the window of recent outcomes
+import requests # for the exception types we retry on
+from urllib3.exceptions import NewConnectionError # for telling whether a request was ever sent
+
+# Status codes that mean the request itself is wrong (or we're logged out), so trying again won't help
+PERMANENT_STATUS_CODES = {400, 401, 403, 404, 422}
+# How many requests' results we look at when deciding whether iKnow is struggling. The rate only changes
+# once per full window - any fewer and a steady trickle of errors looks like a bad patch now and then
+ERROR_WINDOW = 50
+# Slow down once more than this fraction of requests failed, two windows in a row. Even 50 requests
+# is a small sample, so a single window over the line is as likely to be bad luck as iKnow struggling
+SLOW_DOWN_ERROR_RATE = 0.2
+# The slowest we'll ever go, in requests/second
+MIN_RATE = 0.25
+# The rate we fall back from when there was no limit to begin with
+UNLIMITED_FALLBACK_RATE = 8.0
+# How much of the target rate we win back after each window that went fine
+RECOVERY_STEP = 0.25
+
+# Whether a connection error happened before the request went anywhere - we couldn't even connect.
+# Anything else (the connection being reset or dropped, say) may have come after iKnow got the request and acted on it
+def never_sent(error: requests.exceptions.ConnectionError) -> bool:
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+# Retries transient failures (connection errors, 5xx/429 and other non-200s) with exponential backoff
+# and jitter. It also keeps an eye on how many recent requests failed and halves the shared rate limiter
+# when errors pile up, then turns it back up a step at a time while they don't.
+class RetryScheduler:
+    def __init__(self, limiter=None, attempts: int = 4, base_delay: float = 1.0, max_delay: float = 30.0):
+        self.limiter = limiter
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # The rate we were asked to run at - we never go above it
+        self.target_rate = limiter.rate if limiter else 0
+        self.recent = deque(maxlen=ERROR_WINDOW)
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.slowdowns = 0
+        # Whether the last window had too many errors, without having slowed us down yet
+        self.last_window_bad = False
+
+    # Calls send() until it gives back a 200, it fails in a way retrying won't fix, or we run out of attempts.
+    # Returns the last response, or raises the last connection error.
+    # Unless the request is idempotent (a get), connection errors are only retried if it was never sent -
+    # posting again after iKnow may have got it would make a duplicate item or course
+    def call(self, send, idempotent: bool = False) -> requests.Response:
+        for attempt in range(self.attempts):
+            last_attempt = attempt == self.attempts - 1
+            try:
+                res = send()
+            # A read timeout isn't a ConnectionError, so it's never retried. And a bad certificate won't fix itself
+            except requests.exceptions.SSLError:
+                self.record(False)
+                raise
+            except requests.exceptions.ConnectionError as e:
+                self.record(False)
+                if last_attempt or not (idempotent or never_sent(e)):
+                    raise
+                self.backoff(attempt)
+                continue
+            if res.status_code == requests.codes.ok:
+                self.record(True)
+                return res
+            if res.status_code in PERMANENT_STATUS_CODES:
+                # iKnow answered, it just didn't like the request - that's no reason to slow down
+                self.record(True)
+                return res
+            self.record(False)
+            if last_attempt:
+                return res
+            self.backoff(attempt, res.headers.get('Retry-After'))
+        return res
+
+    # Sleeps for an exponentially growing, jittered amount of time before the next attempt
+    def backoff(self, attempt: int, retry_after: str = None) -> None:
+        with self.lock:
+            self.retries += 1
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        # Full jitter, so workers that failed together don't all come back together
+        delay = random.uniform(0, delay)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        time.sleep(delay)
+
+    # Tracks whether a request went through, and adjusts the rate limit to match once a window's worth are in
+    def record(self, success: bool) -> None:
+        with self.lock:
+            self.recent.append(success)
+            if self.limiter is None or len(self.recent) < ERROR_WINDOW:
+                return
+            error_rate = self.recent.count(False) / len(self.recent)
+            # Windows don't overlap, so the same bad patch is never counted twice
+            self.recent.clear()
+            # Where we're heading back to - an unlimited run comes back down from UNLIMITED_FALLBACK_RATE
+            ceiling = self.target_rate if self.target_rate > 0 else UNLIMITED_FALLBACK_RATE
+            current = self.limiter.rate if self.limiter.rate > 0 else ceiling
+            bad = error_rate > SLOW_DOWN_ERROR_RATE
+            slow_down = bad and self.last_window_bad
+            # A slowdown starts things over, so it takes another two bad windows to slow down again
+            self.last_window_bad = bad and not slow_down
+            if slow_down:
+                # Back off hard...
+                self.limiter.set_rate(max(MIN_RATE, current / 2))
+                self.slowdowns += 1
+            elif not bad and self.limiter.rate > 0 and self.limiter.rate != self.target_rate:
+                # ...and recover steadily on the same terms - any window that isn't struggling counts
+                recovered = current + ceiling * RECOVERY_STEP
+                # Back to the target (or unlimited, if that's how we started) once we get there
+                self.limiter.set_rate(self.target_rate if recovered >= ceiling else recovered)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'retries': self.retries,
+                'slowdowns': self.slowdowns,
+                'rate': self.limiter.rate if self.limiter else 0,
+            }
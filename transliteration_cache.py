@@ -0,0 +1,105 @@
+import sqlite3 # for the on-disk cache that survives between runs
+import threading # for sharing the cache between upload workers
+from collections import OrderedDict # for the in-memory LRU
+
+# How many transliterations we keep in memory, and how many new ones we let build up before committing to disk
+DEFAULT_MEMORY_SIZE = 10000
+COMMIT_EVERY = 100
+
+# Caches sentence -> hiragana transliterations, so each sentence only ever goes through pykakasi once.
+# Lookups check an in-memory LRU first, then an sqlite file on disk. Misses are claimed by whoever
+# converts them (see Preprocessor.transliterate), so the same sentence is never converted twice at once.
+class TransliterationCache:
+    def __init__(self, path: str = 'transliteration_cache.db', memory_size: int = DEFAULT_MEMORY_SIZE):
+        self.path = path
+        self.memory_size = memory_size
+        self.memory = OrderedDict()
+        self.db = None
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        # Sentences currently being converted by some worker, mapped to an event set once they're done
+        self.in_flight = {}
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    # Open the disk store on first use, so we don't touch the filesystem unless we need to
+    def open_db(self) -> sqlite3.Connection:
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS transliterations (sentence TEXT PRIMARY KEY, hira TEXT NOT NULL)')
+        return self.db
+
+    def remember(self, sentence: str, trans: str) -> None:
+        self.memory[sentence] = trans
+        self.memory.move_to_end(sentence)
+        if len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    # Checks memory, then disk. Must be called holding the lock. Returns None on a miss
+    def lookup(self, sentence: str):
+        trans = self.memory.get(sentence)
+        if trans is not None:
+            self.memory.move_to_end(sentence)
+            self.memory_hits += 1
+            return trans
+        row = self.open_db().execute('SELECT hira FROM transliterations WHERE sentence = ?', (sentence,)).fetchone()
+        if row is not None:
+            self.disk_hits += 1
+            self.remember(sentence, row[0])
+            return row[0]
+        return None
+
+    # Returns the cached transliteration for a sentence without converting anything, as (transliteration, None)
+    # on a hit. On a miss the sentence is claimed for the caller to convert and hand back with release(), and (None, None) is returned -
+    # unless someone else already claimed it, in which case it's (None, event set once they're done)
+    def claim(self, sentence: str) -> tuple:
+        with self.lock:
+            trans = self.lookup(sentence)
+            if trans is not None:
+                return trans, None
+            waiting_on = self.in_flight.get(sentence)
+            if waiting_on is not None:
+                return None, waiting_on
+            self.misses += 1
+            self.in_flight[sentence] = threading.Event()
+            return None, None
+
+    # Hands back a sentence from claim() with its transliteration, or an empty string if it couldn't be converted
+    def release(self, sentence: str, trans: str) -> None:
+        if trans:
+            self.add(sentence, trans)
+        with self.lock:
+            done = self.in_flight.pop(sentence, None)
+        if done is not None:
+            done.set()
+
+    # Stores a transliteration that was worked out somewhere else
+    def add(self, sentence: str, trans: str) -> None:
+        with self.lock:
+            self.remember(sentence, trans)
+            self.open_db().execute('INSERT OR REPLACE INTO transliterations (sentence, hira) VALUES (?, ?)', (sentence, trans))
+            self.uncommitted += 1
+            if self.uncommitted >= COMMIT_EVERY:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            return {
+                'lookups': lookups,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': hits / lookups if lookups else 0.0,
+            }
+
+    def close(self) -> None:
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
+                self.uncommitted = 0
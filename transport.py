@@ -0,0 +1,132 @@
+import threading # for guarding our connection counters
+import time # for timing requests
+import requests # for posting to iKnow
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Counts how many brand new connections (and so TLS handshakes) we've had to make.
+# Anything else a request went out on was a reused keep-alive connection.
+class ConnectionCounter:
+    def __init__(self):
+        self.new_connections = 0
+        self.lock = threading.Lock()
+
+    def increment(self) -> None:
+        with self.lock:
+            self.new_connections += 1
+
+
+# Build connection pool classes that report to the given counter every time they open a connection
+def counting_pool_classes(counter: ConnectionCounter) -> dict:
+    class CountingHTTPConnectionPool(HTTPConnectionPool):
+        def _new_conn(self):
+            counter.increment()
+            return super()._new_conn()
+
+    class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+        def _new_conn(self):
+            counter.increment()
+            return super()._new_conn()
+
+    return {'http': CountingHTTPConnectionPool, 'https': CountingHTTPSConnectionPool}
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    def __init__(self, counter: ConnectionCounter, **kwargs):
+        self.counter = counter
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = counting_pool_classes(self.counter)
+
+
+# The one place we talk to iKnow from.
+# Owns a keep-alive session so we only pay for the TCP/TLS handshake once per pooled connection,
+# rather than once per word.
+class IKnowTransport:
+    def __init__(self, cookie_string: str, csrf_token: str, pool_size: int = 4, timeout: float = 30.0, limiter=None,
+                 base_url: str = 'https://iknow.jp', retry=None, metrics=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.limiter = limiter
+        # A RetryScheduler to retry transient failures with, if any
+        self.retry = retry
+        # Metrics to record every request's latency and outcome in, if any
+        self.metrics = metrics
+        self.counter = ConnectionCounter()
+        self.requests_made = 0
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        # Size the pool to the number of upload workers so no worker has to wait on, or throw away, a connection
+        adapter = CountingHTTPAdapter(self.counter, pool_connections=1, pool_maxsize=max(1, pool_size))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Define our headers that we'll re-use for every request.
+        # Host and Content-Length are left off - requests works them out for each request.
+        self.session.headers.update({
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:86.0) Gecko/20100101 Firefox/86.0',
+            'Accept': 'application/json, text/javascript, */*; q=0.01',
+            'Accept-Language': 'en-US,en;q=0.5',
+            'Accept-Encoding': 'gzip, deflate, br',
+            'Referer': self.base_url + '/home',
+            'X-CSRF-Token': csrf_token,
+            'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
+            'X-Requested-With': 'XMLHttpRequest',
+            'Origin': self.base_url,
+            'DNT': '1',
+            'Connection': 'keep-alive',
+            'Cookie': cookie_string,
+            'Sec-GPC': '1',
+            'TE': 'Trailers',
+        })
+
+    # Turns a path like /custom/courses into a full url
+    def url(self, path: str) -> str:
+        return self.base_url + path
+
+    # Posts an already url-encoded form payload, retrying transient failures if we have a retry scheduler
+    def post(self, url: str, payload: str) -> requests.Response:
+        if self.retry is None:
+            return self.send(url, payload)
+        return self.retry.call(lambda: self.send(url, payload))
+
+    # Fetches a page, retrying transient failures the same way posts are
+    def get(self, url: str) -> requests.Response:
+        if self.retry is None:
+            return self.send(url)
+        return self.retry.call(lambda: self.send(url), idempotent=True)
+
+    # Makes a single attempt at a request, waiting on the shared rate limiter first.
+    # Posts the payload if there is one, otherwise it's a get
+    def send(self, url: str, payload: str = None) -> requests.Response:
+        if self.limiter:
+            self.limiter.acquire()
+        with self.lock:
+            self.requests_made += 1
+        method = 'GET' if payload is None else 'POST'
+        start = time.perf_counter()
+        try:
+            if payload is None:
+                res = self.session.get(url, timeout=self.timeout)
+            else:
+                res = self.session.post(url, data=payload.encode('utf-8'), timeout=self.timeout)
+        except Exception:
+            if self.metrics:
+                self.metrics.request(url, time.perf_counter() - start, method=method)
+            raise
+        if self.metrics:
+            self.metrics.request(url, time.perf_counter() - start, res.status_code, method)
+        return res
+
+    # Returns counters for how many requests went out on reused vs new connections
+    def stats(self) -> dict:
+        new_connections = self.counter.new_connections
+        return {
+            'requests': self.requests_made,
+            'new_connections': new_connections,
+            'reused_connections': max(0, self.requests_made - new_connections),
+        }
+
+    def close(self) -> None:
+        self.session.close()
@@ -0,0 +1,102 @@
+import threading # for guarding the token bucket between workers
+import time # for refilling the token bucket
+from concurrent.futures import ThreadPoolExecutor
+
+# A global requests/second limiter shared by every upload worker.
+# iKnow's endpoints aren't public, so no matter how many workers we run we never
+# want to go above the configured rate.
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 0):
+        # A rate of 0 (or less) means unlimited
+        self.rate = rate
+        self.capacity = capacity if capacity > 0 else max(1.0, rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Change how many requests/second we allow, 0 meaning unlimited
+    def set_rate(self, rate: float) -> None:
+        with self.lock:
+            self.rate = rate
+            self.capacity = max(1.0, rate)
+            self.tokens = min(self.tokens, self.capacity)
+
+    # Blocks until we're allowed to make another request
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                if self.rate <= 0:
+                    return
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                sleep_for = (1 - self.tokens) / self.rate
+            # Sleep outside the lock so other workers can check in
+            time.sleep(sleep_for)
+
+
+# Runs upload jobs on a bounded pool of worker threads.
+# Nearly all of an import is spent waiting on the network, so threads are plenty here.
+class UploadEngine:
+    def __init__(self, workers: int = 4, requests_per_second: float = 4.0, max_queued: int = 0):
+        self.workers = max(1, int(workers))
+        self.limiter = TokenBucket(requests_per_second)
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='iknow-upload')
+        # Jobs queued or running. Finished ones are dropped straight away - a big import submits a job per word,
+        # and only callers that want a result (and keep the future submit returns) need them after that
+        self.pending = set()
+        self.idle = threading.Condition()
+        # Cap how far ahead of the uploads the caller can get. Courses get assigned when a job is
+        # submitted, so this keeps them from running ahead of what's actually in iKnow if we crash
+        self.slots = threading.BoundedSemaphore(max_queued if max_queued > 0 else self.workers * 2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            # Something went wrong (or we got ctrl+c'd) - don't start anything that's still queued
+            self.cancel()
+        self.shutdown()
+
+    # Queue up a job, blocking if too many are already waiting. Returns the future so callers can look at the result later
+    def submit(self, fn, *args, **kwargs):
+        self.slots.acquire()
+        with self.idle:
+            future = self.pool.submit(fn, *args, **kwargs)
+            self.pending.add(future)
+        future.add_done_callback(self.job_done)
+        return future
+
+    # Runs as each job finishes (or is cancelled)
+    def job_done(self, future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            # A job blowing up shouldn't take the rest of the import with it
+            print('Upload job failed unexpectedly: ' + repr(future.exception()))
+        with self.idle:
+            self.pending.discard(future)
+            if not self.pending:
+                self.idle.notify_all()
+        self.slots.release()
+
+    # Wait for everything queued so far to finish
+    def wait(self) -> None:
+        with self.idle:
+            self.idle.wait_for(lambda: not self.pending)
+
+    # Drop every job that hasn't started yet. Jobs already running are left to finish
+    def cancel(self) -> None:
+        with self.idle:
+            queued = list(self.pending)
+        for future in queued:
+            # Cancelling runs the done callback, which gives the slot back
+            future.cancel()
+
+    def shutdown(self) -> None:
+        self.wait()
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,114 @@
+import json # for the sync state file
+import os # for swapping in the new state file atomically
+import sqlite3 # for reading the kindle's vocab.db
+
+# Every new lookup in vocab.db, with the word and book it belongs to
+NEW_LOOKUPS_QUERY = '''
+SELECT LOOKUPS.id, LOOKUPS.book_key, BOOK_INFO.title, WORDS.word, WORDS.stem, LOOKUPS.usage, LOOKUPS.timestamp
+FROM LOOKUPS
+JOIN WORDS ON WORDS.id = LOOKUPS.word_key
+JOIN BOOK_INFO ON BOOK_INFO.id = LOOKUPS.book_key
+WHERE LOOKUPS.timestamp > ?
+ORDER BY LOOKUPS.timestamp
+'''
+
+# Keeps track of the last lookup we've processed for each book on each device, so a sync only
+# has to deal with what was looked up since the last one.
+#
+# The state file looks like {"devices": {device: {"books": {book_key: last lookup timestamp}}}}
+class VocabSync:
+    def __init__(self, db_file: str, device: str = '', state_path: str = 'vocab_sync_state.json'):
+        self.db_file = db_file
+        # Different kindles can have the same book, so watermarks are kept per device
+        self.device = device if device else os.path.abspath(db_file)
+        self.state_path = state_path
+        self.state = self.load_state()
+        # Watermarks for the lookups we've handed out, only saved once they've been imported
+        self.pending = {}
+
+    def load_state(self) -> dict:
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as s:
+                return json.load(s)
+        except FileNotFoundError:
+            return {'devices': {}}
+
+    def watermarks(self) -> dict:
+        return self.state['devices'].get(self.device, {}).get('books', {})
+
+    # Open the kindle's database read only - it may well be sitting on the kindle itself
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect('file:{path}?mode=ro'.format(path=os.path.abspath(self.db_file)), uri=True)
+
+    # A cheap summary of the LOOKUPS table, (row count, newest timestamp), that changes whenever a lookup is added.
+    # The kindle writes to vocab.db for other reasons too, so this tells us whether there's anything to export
+    def lookups_stamp(self) -> tuple:
+        db = self.connect()
+        try:
+            return tuple(db.execute('SELECT COUNT(*), MAX(timestamp) FROM LOOKUPS').fetchone())
+        finally:
+            db.close()
+
+    # Yields (lookup id, book key, book title, word, stem, usage, timestamp) for every lookup newer
+    # than its book's watermark, oldest first
+    def iter_new_lookups(self):
+        watermarks = self.watermarks()
+        db = self.connect()
+        try:
+            # Anything older than every book's watermark can't be new, unless there's a book we've never seen
+            book_keys = [row[0] for row in db.execute('SELECT id FROM BOOK_INFO')]
+            if watermarks and all(book_key in watermarks for book_key in book_keys):
+                oldest = min(watermarks.values())
+            else:
+                oldest = 0
+            for row in db.execute(NEW_LOOKUPS_QUERY, (oldest,)):
+                book_key, timestamp = row[1], row[6]
+                if timestamp <= watermarks.get(book_key, 0):
+                    continue
+                if timestamp > self.pending.get(book_key, 0):
+                    self.pending[book_key] = timestamp
+                yield row
+        finally:
+            db.close()
+
+    # Writes a copy of vocab.db holding only the new lookups (and the words/books they point at)
+    # to db_path, for the kindle_to_json converter to turn into kindle data.
+    # Returns the number of new lookups, 0 meaning there's nothing to do.
+    def export_new_lookups(self, db_path: str = 'vocab_new.db') -> int:
+        lookup_ids = [row[0] for row in self.iter_new_lookups()]
+        if not lookup_ids:
+            return 0
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        out = sqlite3.connect(db_path)
+        try:
+            source = self.connect()
+            tables = source.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table' AND sql IS NOT NULL").fetchall()
+            source.close()
+            for _, sql in tables:
+                out.execute(sql)
+            out.execute('ATTACH DATABASE ? AS source', ('file:{path}?mode=ro'.format(path=os.path.abspath(self.db_file)),))
+            out.execute('CREATE TEMP TABLE new_lookups (id TEXT PRIMARY KEY)')
+            out.executemany('INSERT INTO new_lookups (id) VALUES (?)', ((lookup_id,) for lookup_id in lookup_ids))
+            out.execute('INSERT INTO main.LOOKUPS SELECT * FROM source.LOOKUPS WHERE id IN (SELECT id FROM new_lookups)')
+            out.execute('INSERT INTO main.WORDS SELECT * FROM source.WORDS WHERE id IN (SELECT word_key FROM main.LOOKUPS)')
+            out.execute('INSERT INTO main.BOOK_INFO SELECT * FROM source.BOOK_INFO WHERE id IN (SELECT book_key FROM main.LOOKUPS)')
+            # Everything else (dictionary info, metadata...) is tiny, so just bring it all along
+            for name, _ in tables:
+                if name not in ('LOOKUPS', 'WORDS', 'BOOK_INFO'):
+                    out.execute('INSERT INTO main."{name}" SELECT * FROM source."{name}"'.format(name=name))
+            out.commit()
+        finally:
+            out.close()
+        return len(lookup_ids)
+
+    # Saves the watermarks for everything handed out so far. Only call this once it's been imported
+    def commit(self) -> None:
+        books = self.state['devices'].setdefault(self.device, {}).setdefault('books', {})
+        for book_key, timestamp in self.pending.items():
+            books[book_key] = max(timestamp, books.get(book_key, 0))
+        self.pending = {}
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as s:
+            s.write(json.dumps(self.state, indent=4, ensure_ascii=False))
+        os.replace(temp_path, self.state_path)